@@ -20,6 +20,7 @@ class MDRResponder(Responder):
         self.client_id = self.get_param('config.client_id', None)
         self.token_dir = self.get_param('config.token_dir', None)
         self.ssl_cert = self.get_param('config.ssl_cert', False)
+        self.http = None
         config_path = self.get_param('config.config_path', None)
         if config_path:
             with open(config_path, 'r') as f:
@@ -28,10 +29,19 @@ class MDRResponder(Responder):
                 self.client_id = config.get('client_id')
                 self.ssl_cert = config.get('ssl_cert')
                 self.token_dir = config.get('token_dir')
+                self.http = config.get('http')
     
     def initMDRConnection(self):
         access_token = self.get_access_token(self.token_dir)
-        self.mdr = MDRConsole(api_url = self.api_url, client_id = self.client_id, access_token = access_token, ssl_cert = self.ssl_cert)
+        # on 401 the token is read again, the token updater keeps .access_token refreshed
+        self.mdr = MDRConsole(
+            api_url = self.api_url,
+            client_id = self.client_id,
+            access_token = access_token,
+            ssl_cert = self.ssl_cert,
+            http = self.http,
+            token_provider = lambda stale_token: self.get_access_token(self.token_dir)
+        )
 
     def get_access_token(self, token_dir: str) -> str:
         with open(f'{token_dir}/.access_token', 'r') as f:
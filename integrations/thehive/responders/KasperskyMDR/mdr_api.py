@@ -1,9 +1,40 @@
 import requests
-from typing import Optional, Dict, Any, List
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, Any, List, Callable
 import os
 import json
 
 
+# Keep-alive sessions shared by all MDRConsole instances of a process. Reusing
+# the pooled connections also reuses their TLS sessions, so only the first
+# request to a host pays for the TCP and TLS handshakes.
+_sessions = {}
+
+
+def get_session(pool_connections: int = 10, pool_maxsize: int = 10, pool_block: bool = False, pool_hosts: Optional[Dict[str, int]] = None) -> requests.Session:
+    """
+    pool_connections - how many per-host pools are cached
+    pool_maxsize - how many keep-alive connections are kept per host
+    pool_block - wait for a free connection instead of opening an extra one
+    pool_hosts - per-host pool size overrides, e.g. {"mdr.kaspersky.com": 20}
+    """
+    pool_hosts = pool_hosts or {}
+    # sockets must not be shared with a forked child, so the key includes the pid
+    key = (os.getpid(), pool_connections, pool_maxsize, pool_block, tuple(sorted(pool_hosts.items())))
+    session = _sessions.get(key)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_connections, pool_maxsize = pool_maxsize, pool_block = pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        for host, maxsize in pool_hosts.items():
+            host_adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = maxsize, pool_block = pool_block)
+            session.mount(f'https://{host}', host_adapter)
+            session.mount(f'http://{host}', host_adapter)
+        _sessions[key] = session
+    return session
+
+
 class MDRConsole():
 
     ASSETS_COUNT_PATH = "assets/count"
@@ -24,27 +55,68 @@ class MDRConsole():
     SESSION_CONFIRM_PATH = "session/confirm"
     INCIDENT_CLOSE_PATH = "incidents/close"
 
-    def __init__(self, api_url: str, client_id: str, refresh_token: Optional[str] = None, access_token: Optional[str] = None, ssl_cert: Optional[str] = False) -> None:
+    def __init__(self, api_url: str, client_id: str, refresh_token: Optional[str] = None, access_token: Optional[str] = None, ssl_cert: Optional[str] = False, http: Optional[Dict[str, Any]] = None, token_provider: Optional[Callable[[Optional[str]], str]] = None) -> None:
+        """
+        token_provider(stale_token) returns a new access token when MDR rejects the current one with 401,
+        the request is repeated once with it.
+        Example:
+        http = {
+            "timeout": 60,  # seconds
+            "pool_connections": 10,
+            "pool_maxsize": 10,
+            "pool_block": False,
+            "pool_hosts": {"mdr.kaspersky.com": 10}
+        }
+        """
         self.api_url = api_url
         self.client_id = client_id
         self.ssl_cert = ssl_cert
+        self.token_provider = token_provider
+        http = http or {}
+        self.timeout = http.get('timeout')
+        self.pool = {
+            'pool_connections': http.get('pool_connections', 10),
+            'pool_maxsize': http.get('pool_maxsize', 10),
+            'pool_block': http.get('pool_block', False),
+            'pool_hosts': http.get('pool_hosts'),
+        }
         if refresh_token:
             self.access_token, self.refresh_token = self.get_access_token(refresh_token)
         elif access_token:
             self.access_token = access_token
     
 
-    def post(self, *, path: str, json_data: Dict[str, Any], headers: Optional[Dict[str, str]] = None, download: Optional[bool] = False) -> Dict:
+    @property
+    def session(self) -> requests.Session:
+        return get_session(**self.pool)
+
+
+    def post(self, *, path: str, json_data: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None, download: Optional[bool] = False, files: Optional[Dict[str, Any]] = None, data: Optional[Dict[str, Any]] = None) -> Dict:
         kwargs = {
             "url": f"{self.api_url}/{self.client_id}/{path}",
-            "json": json_data,
             "verify": self.ssl_cert,
+            "timeout": self.timeout,
         }
+        if json_data is not None:
+            kwargs["json"] = json_data
         if headers is not None:
             kwargs["headers"] = headers
+        if files is not None:
+            kwargs["files"] = files
+        if data is not None:
+            kwargs["data"] = data
         #print(path)
-        resp = requests.post(**kwargs)
+        resp = self.session.post(**kwargs)
         #print(kwargs)
+        if resp.status_code == 401 and self.token_provider and headers and 'Authorization' in headers:
+            # the token has expired or been revoked, the request is repeated once with a new one
+            resp.close()
+            self.access_token = self.token_provider(self.access_token)
+            kwargs["headers"] = dict(headers, **self.get_auth_header(self.access_token))
+            for value in (files or {}).values():
+                if isinstance(value, tuple) and hasattr(value[1], 'seek'):
+                    value[1].seek(0)
+            resp = self.session.post(**kwargs)
 
         if resp.status_code == 200:
             if download:
@@ -86,7 +158,7 @@ class MDRConsole():
         }
         """
         headers = self.get_auth_header(self.access_token)
-        result = post(path = self.ASSETS_COUNT_PATH, json_data = kwargs, headers=headers)
+        result = self.post(path = self.ASSETS_COUNT_PATH, json_data = kwargs, headers=headers)
         return result
 
 
@@ -172,26 +244,23 @@ class MDRConsole():
             
         }
         """
-        path = self.ATTACHMENTS_UPLOAD_PATH
         headers = self.get_auth_header(self.access_token)
-        resp = requests.post(
-            url = f"{self.api_url}/{self.client_id}/{path}",
-            headers = headers,
-            files = {
-                'file': (
-                    os.path.basename(kwargs['file']),
-                    open(kwargs['file'], 'rb'),
-                    'application/octet-stream'
-                )
-            },
-            data = {
-                'meta': json.dumps(kwargs['meta'])
-            }
-        )
-        if resp.status_code == 200:
-            return resp.json()
-        else:
-            raise Exception(f'Request to {path}, HTTP code {str(resp.status_code)} - {resp.text}')
+        with open(kwargs['file'], 'rb') as f:
+            result = self.post(
+                path = self.ATTACHMENTS_UPLOAD_PATH,
+                headers = headers,
+                files = {
+                    'file': (
+                        os.path.basename(kwargs['file']),
+                        f,
+                        'application/octet-stream'
+                    )
+                },
+                data = {
+                    'meta': json.dumps(kwargs['meta'])
+                }
+            )
+        return result
 
 
     def comments_create(self, incident_id: str, text: str, **kwargs) -> Dict[str, Any]:
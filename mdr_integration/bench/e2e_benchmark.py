@@ -0,0 +1,342 @@
+"""
+End-to-end throughput benchmark. Starts the mock MDR and sink servers of
+bench/mock_servers.py, then runs the real TokenUpdater, MDRSync,
+AttachmentDownloader and KUMA or TheHive loops in their own processes the way
+main.py does, until every update of the scenario is delivered to the sink.
+The run is complete when MDRSync has fetched the last incident of the scenario
+and the spool and the download queue are empty. Reports updates per second, the
+update_latency_seconds quantiles per update type and stage, and the peak RSS of
+every process. Updates delivered again after failures are counted as delivered
+updates, so they may exceed the expected ones.
+Example (from the mdr_integration directory):
+python -m bench.e2e_benchmark --incidents 1000 --comments 20 --attachments 2 --attachment-size 1048576
+python -m bench.e2e_benchmark --sink thehive --arrival-rate 20 --sink-latency 0.05 --sink-error-rate 0.01
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+import tempfile
+import functools
+import multiprocessing
+from typing import Optional, Dict, Any, List
+
+from src.token_updater import TokenUpdater
+from src.mdr_sync import MDRSync
+from src.attachment_downloader import AttachmentDownloader, get_queue_dir
+from src.spool import get_spool
+from src.token_broker import SOCKET_NAME
+from src.logger import MDRLogger, configure_process
+from src import metrics
+from src.metrics import MetricsServer
+from bench.mock_servers import Faults, Scenario, MockMDR, MockKUMA, MockTheHive
+
+CLIENT_ID = 'bench'
+# sink_updates_total results which finish an update
+DONE_RESULTS = ('processed', 'coalesced', 'skipped')
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'End-to-end throughput benchmark of the MDR integration against local mock servers')
+    scenario = parser.add_argument_group('scenario')
+    scenario.add_argument('--incidents', type = int, default = 200, help = 'MDR incidents, default 200')
+    scenario.add_argument('--comments', type = int, default = 5, help = 'comments per incident, default 5')
+    scenario.add_argument('--attachments', type = int, default = 1, help = 'attachments per incident, default 1')
+    scenario.add_argument('--responses', type = int, default = 1, help = 'responses per incident, default 1')
+    scenario.add_argument('--hosts', type = int, default = 2, help = 'affected hosts (TheHive observables) per incident, default 2')
+    scenario.add_argument('--attachment-size', type = int, default = 65536, help = 'bytes, default 65536')
+    scenario.add_argument('--closed-ratio', type = float, default = 0, help = 'share of closed incidents, default 0')
+    scenario.add_argument('--arrival-rate', type = float, default = 0, help = 'incidents appearing in MDR per second, 0 (default) - all of them exist at the start')
+    scenario.add_argument('--token-ttl', type = int, default = 3600, help = 'seconds the MDR access tokens live, default 3600')
+    faults = parser.add_argument_group('faults')
+    faults.add_argument('--mdr-latency', type = float, default = 0, help = 'seconds added to every MDR request, default 0')
+    faults.add_argument('--mdr-jitter', type = float, default = 0, help = 'random seconds added to --mdr-latency, default 0')
+    faults.add_argument('--mdr-error-rate', type = float, default = 0, help = 'share of MDR requests answered with 503 (session/confirm excluded), default 0')
+    faults.add_argument('--sink-latency', type = float, default = 0, help = 'seconds added to every sink request, default 0')
+    faults.add_argument('--sink-jitter', type = float, default = 0, help = 'random seconds added to --sink-latency, default 0')
+    faults.add_argument('--sink-error-rate', type = float, default = 0, help = 'share of sink requests answered with 503, default 0')
+    service = parser.add_argument_group('service')
+    service.add_argument('--sink', choices = ['kuma', 'thehive'], default = 'kuma', help = 'default kuma')
+    service.add_argument('--mode', choices = ['incidents', 'headers', 'history'], default = 'incidents', help = 'mdr_sync.mode, default incidents')
+    service.add_argument('--spool', choices = ['files', 'sqlite'], default = 'files', help = 'spool.type, default files')
+    service.add_argument('--page-size', type = int, default = 100, help = 'mdr_sync.page_size, default 100')
+    service.add_argument('--max-incidents', type = int, default = 1000, help = 'mdr_sync.max_incidents_at_time, default 1000')
+    service.add_argument('--poll-period', type = float, default = 1, help = 'mdr_sync.min_period, seconds, default 1')
+    service.add_argument('--batch-size', type = int, default = 500, help = 'spool.batch_size, default 500')
+    service.add_argument('--settle-delay', type = float, default = 2, help = 'spool.settle_delay, seconds, default 2')
+    service.add_argument('--workers', type = int, default = 4, help = 'workers of the sink, default 4')
+    service.add_argument('--sink-period', type = float, default = 5, help = 'kuma.period or thehive.period, seconds, failed updates are retried so late, default 5')
+    service.add_argument('--download-workers', type = int, default = 4, help = 'attachment_downloader.workers, default 4')
+    service.add_argument('--rate-limit', type = float, default = 1000, help = 'kuma.rate_limit, requests per second, default 1000')
+    service.add_argument('--log-level', default = 'INFO', help = 'default INFO')
+    parser.add_argument('--timeout', type = float, default = 600, help = 'seconds to wait for the delivery of all updates, default 600')
+    parser.add_argument('--output', help = 'write the results as JSON to this file')
+    parser.add_argument('--keep', action = 'store_true', help = 'keep the working directory with the spool, the indexes and the log')
+    return parser.parse_args(argv)
+
+
+def build_config(args: argparse.Namespace, work_dir: str, mdr: MockMDR, sink: Any) -> Dict[str, Any]:
+    # the same structure as conf/config.yml, see conf/sample_config.yml
+    return {
+        'api_url': mdr.url,
+        'client_id': CLIENT_ID,
+        'token_dir': f'{work_dir}/conf',
+        'data_dir': f'{work_dir}/data',
+        'spool': {
+            'type': args.spool,
+            'batch_size': args.batch_size,
+            'debounce': 0.2,
+            'poll_interval': 1,
+            'coalesce': True,
+            'settle_delay': args.settle_delay
+        },
+        'http': {'timeout': 60},
+        'token_updater': {'period': 600, 'refresh_ahead': 120, 'jitter': 30},
+        'mdr_sync': {
+            'period': args.poll_period,
+            'min_period': args.poll_period,
+            'max_period': max(args.poll_period, 5),
+            'backoff': 2,
+            'mode': args.mode,
+            'max_incidents_at_time': args.max_incidents,
+            'page_size': args.page_size,
+            'download_attachments_size_limit': None,
+            'filter': {'incidents': {}},
+            'exclude_author': 'benchmark-self'
+        },
+        'attachment_downloader': {'period': 1, 'workers': args.download_workers, 'max_attempts': 5},
+        'attachment_store': {},
+        'kuma': {
+            'api_url': sink.url,
+            'api_token': 'bench',
+            'tenant_id': '00000000-0000-0000-0000-000000000000',
+            'period': args.sink_period,
+            'workers': args.workers,
+            'timeout': 30,
+            'rate_limit': args.rate_limit,
+            'burst': max(int(args.rate_limit), 1),
+            'retries': 3,
+            'backoff': 0.1
+        },
+        'thehive': {
+            'api_url': sink.url,
+            'api_key': 'bench',
+            'period': args.sink_period,
+            'workers': args.workers
+        },
+        'metrics': {'flush_interval': 0.5},
+        'logging': {
+            'log_dir': f'{work_dir}/log',
+            'log_level': args.log_level,
+            'queue_size': 10000
+        }
+    }
+
+
+def process_configurer(queue: Any, metrics_queue: Any, config: Dict[str, Any]) -> None:
+    # main.process_logging_configurer, main.py can't be imported since it reads conf/config.yml
+    configure_process(queue, config['logging'])
+    metrics.configure(metrics_queue, flush_interval = config['metrics']['flush_interval'])
+
+
+def prepare_work_dir(work_dir: str, mdr: MockMDR) -> None:
+    for name in ('conf', 'data', 'log'):
+        os.makedirs(f'{work_dir}/{name}', exist_ok = True)
+    with open(f'{work_dir}/conf/.refresh_token', 'w') as f:
+        f.write(mdr.issue_refresh_token())
+    open(f'{work_dir}/conf/.access_token', 'w').close()
+
+
+def wait_for_token(token_dir: str, timeout: float = 30) -> bool:
+    # the token broker is listening and the first access token is written
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(f'{token_dir}/{SOCKET_NAME}') and os.path.getsize(f'{token_dir}/.access_token'):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def is_drained(mdr: MockMDR, spool: Any, data_dir: str, token_dir: str) -> bool:
+    # every update has been fetched from MDR, downloaded and delivered to the sink,
+    # and no failed incident is left to be retried by MDRSync
+    return mdr.drained and not get_retries(token_dir) and not os.listdir(get_queue_dir(data_dir)) and spool.count('pending') == 0
+
+
+def get_retries(token_dir: str) -> Dict[str, Any]:
+    try:
+        with open(f'{token_dir}/.retries', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_counter(server: MetricsServer, name: str, **labels) -> float:
+    # sum over the series of the metric having the given labels
+    wanted = {(key, str(value)) for key, value in labels.items()}
+    with server.lock:
+        return sum(value for (metric, series), value in server.counters.items() if metric == name and wanted <= set(series))
+
+
+def get_peak_rss(pid: Optional[int]) -> Optional[int]:
+    # bytes, the high-water mark of the resident set, Linux only
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def get_self_peak_rss() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def format_size(size: Optional[int]) -> str:
+    return 'n/a' if size is None else f'{size / 1048576:.1f} MiB'
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    scenario = Scenario(
+        incidents = args.incidents,
+        comments = args.comments,
+        attachments = args.attachments,
+        responses = args.responses,
+        hosts = args.hosts,
+        attachment_size = args.attachment_size,
+        closed_ratio = args.closed_ratio,
+        arrival_rate = args.arrival_rate
+    )
+    mdr = MockMDR(scenario, client_id = CLIENT_ID, token_ttl = args.token_ttl, faults = Faults(args.mdr_latency, args.mdr_jitter, args.mdr_error_rate))
+    sink_faults = Faults(args.sink_latency, args.sink_jitter, args.sink_error_rate)
+    sink = MockKUMA(sink_faults) if args.sink == 'kuma' else MockTheHive(sink_faults)
+    mdr.start()
+    sink.start()
+    work_dir = tempfile.mkdtemp(prefix = 'mdr-bench-')
+    prepare_work_dir(work_dir, mdr)
+    config = build_config(args, work_dir, mdr, sink)
+
+    logging_queue = multiprocessing.Queue(config['logging']['queue_size'])
+    logging_listener = multiprocessing.Process(target = MDRLogger().run, args = (logging_queue, config['logging']), name = 'logger')
+    logging_listener.start()
+    metrics_queue = multiprocessing.Queue(1000)
+    metrics_server = MetricsServer(metrics_queue, window = 1000000)
+    threading.Thread(target = metrics_server.collect, daemon = True).start()
+    configurer = functools.partial(process_configurer, metrics_queue = metrics_queue, config = config)
+
+    processes = {}
+    try:
+        processes['token_updater'] = multiprocessing.Process(target = TokenUpdater(config).run, args = (logging_queue, configurer), name = 'token_updater')
+        processes['token_updater'].start()
+        if not wait_for_token(config['token_dir']):
+            raise RuntimeError('the token updater has not got an access token from the mock MDR')
+        processes['mdr_sync'] = multiprocessing.Process(target = MDRSync(config).run, args = (logging_queue, configurer), name = 'mdr_sync')
+        processes['attachment_downloader'] = multiprocessing.Process(target = AttachmentDownloader(config).run, args = (logging_queue, configurer), name = 'attachment_downloader')
+        # the sink is imported only when it's benchmarked, thehive4py isn't needed for KUMA
+        if args.sink == 'kuma':
+            from src.integration_kuma import KUMA
+            sink_loop = KUMA(config)
+        else:
+            from src.integration_thehive import TheHive
+            sink_loop = TheHive(config)
+        processes[args.sink] = multiprocessing.Process(target = sink_loop.run, args = (logging_queue, configurer), name = args.sink)
+
+        spool = get_spool(config)
+        expected = scenario.expected_updates()
+        scenario.reset()
+        started = time.monotonic()
+        for name in ('mdr_sync', 'attachment_downloader', args.sink):
+            processes[name].start()
+        completed = False
+        while time.monotonic() - started < args.timeout:
+            if is_drained(mdr, spool, config['data_dir'], config['token_dir']):
+                completed = True
+                break
+            dead = [name for name, process in processes.items() if not process.is_alive()]
+            if dead:
+                raise RuntimeError(f'process(es) {", ".join(dead)} exited, see {config["logging"]["log_dir"]}/app.log')
+            time.sleep(0.2)
+        elapsed = time.monotonic() - started
+        # the counters of the last deliveries are sent with the next flush of the sink
+        time.sleep(config['metrics']['flush_interval'] * 2)
+        peak_rss = {name: get_peak_rss(process.pid) for name, process in processes.items()}
+        peak_rss['benchmark'] = get_self_peak_rss()
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+            process.join(10)
+        logging_queue.put(None)
+        logging_listener.join(10)
+        mdr.stop()
+        sink.stop()
+
+    latency = {}
+    for series, quantiles in metrics_server.get_quantiles('update_latency_seconds').items():
+        labels = dict(item.split('=', 1) for item in series.split(','))
+        latency.setdefault(labels['update_type'], {})[labels['stage']] = quantiles
+    delivered = sum(get_counter(metrics_server, 'sink_updates_total', result = result) for result in DONE_RESULTS)
+    results = {
+        'scenario': {key: value for key, value in vars(args).items() if key not in ('output', 'keep')},
+        'completed': completed,
+        'expected_updates': expected,
+        'delivered_updates': delivered,
+        'failed_deliveries': get_counter(metrics_server, 'sink_updates_total', result = 'failed'),
+        'elapsed_seconds': elapsed,
+        'updates_per_second': delivered / elapsed if elapsed else 0,
+        'incidents_per_second': args.incidents / elapsed if completed and elapsed else 0,
+        'latency_seconds': latency,
+        'peak_rss_bytes': peak_rss,
+        'mdr': mdr.get_stats(),
+        'sink': sink.get_stats(),
+        'work_dir': work_dir if args.keep else None
+    }
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors = True)
+    return results
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    print(f"{'completed' if results['completed'] else 'TIMED OUT'}: {results['delivered_updates']:.0f} of {results['expected_updates']} updates "
+          f"delivered in {results['elapsed_seconds']:.1f}s, {results['failed_deliveries']:.0f} failed deliveries retried")
+    print(f"throughput: {results['updates_per_second']:.1f} updates/s, {results['incidents_per_second']:.1f} incidents/s")
+    print('latency, seconds (p50 / p90 / p99):')
+    for update_type, stages in sorted(results['latency_seconds'].items()):
+        line = '  '.join(
+            f"{stage} {stages[stage]['p50']:.2f} / {stages[stage]['p90']:.2f} / {stages[stage]['p99']:.2f}"
+            for stage in ('fetch', 'write', 'delivery', 'total') if stage in stages
+        )
+        print(f'  {update_type:16} {line}')
+    print('peak RSS:')
+    for name, size in results['peak_rss_bytes'].items():
+        print(f'  {name:22} {format_size(size)}')
+    print(f"MDR requests: {results['mdr']['requests']}, errors: {results['mdr']['errors']}")
+    print(f"sink requests: {results['sink']['requests']}, errors: {results['sink']['errors']}")
+    if results['work_dir']:
+        print(f"working directory: {results['work_dir']}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    results = run_benchmark(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+    return 0 if results['completed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
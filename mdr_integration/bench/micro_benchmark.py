@@ -0,0 +1,356 @@
+"""
+Microbenchmarks of the sync hot paths on synthetic fixtures, without network:
+parse_incident_updates - MDRSync parses one incident with 10k comments and 10k attachments
+push_updates - MDRSync writes 10k comment updates to the spool
+scan_folder - KUMA claims a batch from a spool of 100k updates
+kuma_process_updates, thehive_process_updates - one cycle of the sink over 3200 updates
+of 100 incidents, the sink APIs are in-process fakes answering at once
+Every benchmark is repeated, the fastest run is compared with bench/baselines.json.
+The baselines are only comparable on the machine they have been saved on and for
+the same fixture sizes, save them again with --save after changing either.
+Logging is disabled, so the time of the log formatting isn't measured.
+Example (from the mdr_integration directory):
+python -m bench.micro_benchmark
+python -m bench.micro_benchmark --only scan_folder --repeat 10
+python -m bench.micro_benchmark --save
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import fnmatch
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+from typing import Optional, Dict, Any, List, Tuple, Callable
+
+from src.mdr_sync import MDRSync
+from src.attachment_downloader import get_queue_dir
+from bench.mock_servers import Scenario
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+
+class FakeResponse():
+
+    def __init__(self, status_code: int, document: Any = None) -> None:
+        self.status_code = status_code
+        self.document = document
+        self.text = json.dumps(document)
+
+
+    def json(self) -> Any:
+        return self.document
+
+
+class FakeKUMAApi():
+    # KUMA_API answering every request at once
+
+    def create_incident(self, incident_data: Dict[str, Any]) -> FakeResponse:
+        return FakeResponse(200, {'id': f"kuma-{incident_data['name']}", 'name': incident_data['name']})
+
+
+    def create_incidents(self, incidents_data: List[Dict[str, Any]]) -> List[FakeResponse]:
+        return [self.create_incident(incident_data) for incident_data in incidents_data]
+
+
+    def comment_incident(self, incident_id: str, comment: str) -> FakeResponse:
+        return FakeResponse(200, {})
+
+
+    def close_incident(self, incident_id: str, resolution: str) -> FakeResponse:
+        return FakeResponse(200, {})
+
+
+class FakeTheHiveApi():
+    # TheHiveApi answering every request at once, no case exists before the benchmark
+
+    def find_cases(self, **attributes) -> FakeResponse:
+        return FakeResponse(200, [])
+
+
+    def find_tasks(self, **attributes) -> FakeResponse:
+        return FakeResponse(200, [])
+
+
+    def get_case_tasks(self, case_id: str) -> FakeResponse:
+        return FakeResponse(200, [{'id': f'{case_id}-task', 'title': 'MDR Response', '_parent': case_id}])
+
+
+    def create_case(self, case: Any) -> FakeResponse:
+        return FakeResponse(201, {'id': f'case-{uuid.uuid4().hex}'})
+
+
+    def create_case_observable(self, case_id: str, observable: Any) -> FakeResponse:
+        return FakeResponse(201, [])
+
+
+    def update_case(self, case: Any, fields: List[str]) -> FakeResponse:
+        return FakeResponse(200, {'id': case.id})
+
+
+    def create_case_task(self, case_id: str, task: Any) -> FakeResponse:
+        return FakeResponse(201, {'id': f'{case_id}-{task.title}'})
+
+
+    def create_task_log(self, task_id: str, case_task_log: Any) -> FakeResponse:
+        return FakeResponse(201, {'id': f'{task_id}-log'})
+
+
+def build_config(work_dir: str, spool_type: str, batch_size: Optional[int] = None) -> Dict[str, Any]:
+    # the same structure as conf/config.yml, nothing is listening on the URLs
+    return {
+        'api_url': 'http://127.0.0.1:9',
+        'client_id': 'bench',
+        'token_dir': f'{work_dir}/conf',
+        'data_dir': f'{work_dir}/data',
+        'spool': {'type': spool_type, 'batch_size': batch_size, 'coalesce': True, 'settle_delay': 0},
+        'mdr_sync': {
+            'download_attachments_size_limit': None,
+            'filter': {'incidents': {}},
+            'exclude_author': 'benchmark-self'
+        },
+        'attachment_store': {},
+        'kuma': {'api_url': 'http://127.0.0.1:9', 'api_token': 'bench', 'tenant_id': '00000000-0000-0000-0000-000000000000', 'workers': 4},
+        'thehive': {'api_url': 'http://127.0.0.1:9', 'api_key': 'bench', 'workers': 4}
+    }
+
+
+def prepare_work_dir(work_dir: str) -> None:
+    for name in ('conf', 'data'):
+        os.makedirs(f'{work_dir}/{name}', exist_ok = True)
+    with open(f'{work_dir}/conf/.access_token', 'w') as f:
+        f.write('bench')
+
+
+def get_mdr_sync(config: Dict[str, Any]) -> MDRSync:
+    mdr_sync = MDRSync(config)
+    mdr_sync.logger = logging.getLogger('src.mdr_sync')
+    return mdr_sync
+
+
+def fill_spool(spool: Any, scenario: Scenario) -> None:
+    # the updates MDRSync pushes for incidents seen for the first time, attachments as downloaded
+    for number in range(scenario.incidents):
+        incident = scenario.get_incident(number)
+        incident_id = incident['incident_id']
+        children = {entity: incident.pop(entity) for entity in ('comments', 'attachments', 'responses')}
+        spool.push('new_incident', incident['creation_time'], incident)
+        spool.push('update_incident', incident['update_time'], incident)
+        for entity, update_type in (('comments', 'new_comment'), ('attachments', 'new_attachment'), ('responses', 'new_response')):
+            for child in children[entity]:
+                spool.push(update_type, child['creation_time'], {'incident_id': incident_id, entity: [child]})
+
+
+def bench_parse_incident_updates(work_dir: str, spool_type: str, size: Dict[str, int]) -> Tuple[Callable[[], Any], Callable[[], int]]:
+    config = build_config(work_dir, spool_type)
+    mdr_sync = get_mdr_sync(config)
+    scenario = Scenario(incidents = 1, comments = size['comments'], attachments = size['attachments'], responses = 0)
+    incident = scenario.get_incident(0)
+
+    def verify():
+        # the attachments aren't in the attachment store, they are queued for download
+        return mdr_sync.spool.count('pending') + len(os.listdir(get_queue_dir(config['data_dir'])))
+
+    return lambda: mdr_sync.parse_incident_updates(incident, 0), verify
+
+
+def bench_push_updates(work_dir: str, spool_type: str, size: Dict[str, int]) -> Tuple[Callable[[], Any], Callable[[], int]]:
+    mdr_sync = get_mdr_sync(build_config(work_dir, spool_type))
+    scenario = Scenario(incidents = 1, comments = size['updates'], attachments = 0, responses = 0)
+    comments = scenario.get_comments(0)
+
+    def run():
+        for comment in comments:
+            mdr_sync.push_updates('new_comment', comment['creation_time'], {'incident_id': 'bench-0', 'comments': [comment]})
+
+    return run, lambda: mdr_sync.spool.count('pending')
+
+
+def bench_scan_folder(work_dir: str, spool_type: str, size: Dict[str, int]) -> Tuple[Callable[[], Any], Callable[[], int]]:
+    from src.integration_kuma import KUMA
+    config = build_config(work_dir, spool_type, batch_size = size['batch_size'])
+    kuma = KUMA(config)
+    kuma.logger = logging.getLogger('src.integration_kuma')
+    scenario = Scenario(incidents = size['updates'] // size['per_incident'], comments = size['per_incident'] - 2, attachments = 0, responses = 0)
+    fill_spool(kuma.spool, scenario)
+    claimed = []
+
+    def run():
+        claimed[:] = kuma.scan_folder()
+
+    return run, lambda: len(claimed)
+
+
+def bench_kuma_process_updates(work_dir: str, spool_type: str, size: Dict[str, int]) -> Tuple[Callable[[], Any], Callable[[], int]]:
+    from src.integration_kuma import KUMA
+    kuma = KUMA(build_config(work_dir, spool_type))
+    kuma.logger = logging.getLogger('src.integration_kuma')
+    kuma.api = FakeKUMAApi()
+    return process_updates(kuma, size)
+
+
+def bench_thehive_process_updates(work_dir: str, spool_type: str, size: Dict[str, int]) -> Tuple[Callable[[], Any], Callable[[], int]]:
+    # thehive4py is imported only when TheHive is benchmarked
+    from src.integration_thehive import TheHive
+    thehive = TheHive(build_config(work_dir, spool_type))
+    thehive.logger = logging.getLogger('src.integration_thehive')
+    thehive.api = FakeTheHiveApi()
+    return process_updates(thehive, size)
+
+
+def process_updates(sink: Any, size: Dict[str, int]) -> Tuple[Callable[[], Any], Callable[[], int]]:
+    scenario = Scenario(incidents = size['incidents'], comments = size['comments'], attachments = size['attachments'], responses = size['responses'], hosts = 2)
+    fill_spool(sink.spool, scenario)
+    stats = {}
+
+    def run():
+        stats.update(sink.process_updates())
+
+    # the older update_incident of an incident is coalesced, the rest is delivered
+    return run, lambda: stats.get('processed', 0) + stats.get('coalesced', 0)
+
+
+# name: (setup, fixture size, number of the items handled by one run)
+BENCHMARKS = {
+    'parse_incident_updates': (bench_parse_incident_updates, {'comments': 10000, 'attachments': 10000}, lambda size: size['comments'] + size['attachments'] + 2),
+    'push_updates': (bench_push_updates, {'updates': 10000}, lambda size: size['updates']),
+    'scan_folder': (bench_scan_folder, {'updates': 100000, 'per_incident': 100, 'batch_size': 500}, lambda size: size['batch_size']),
+    'kuma_process_updates': (bench_kuma_process_updates, {'incidents': 100, 'comments': 20, 'attachments': 5, 'responses': 5}, lambda size: size['incidents'] * (2 + size['comments'] + size['attachments'] + size['responses'])),
+    'thehive_process_updates': (bench_thehive_process_updates, {'incidents': 100, 'comments': 20, 'attachments': 5, 'responses': 5}, lambda size: size['incidents'] * (2 + size['comments'] + size['attachments'] + size['responses'])),
+}
+# the fixture isn't changed by a run, it's built once for all the repeats
+REUSABLE = {'scan_folder'}
+
+
+def scale_size(size: Dict[str, int], scale: float) -> Dict[str, int]:
+    return {key: value if key in ('per_incident', 'batch_size') else max(int(value * scale), 1) for key, value in size.items()}
+
+
+def run_benchmark(name: str, spool_type: str, scale: float, repeat: int) -> Dict[str, Any]:
+    setup, size, get_items = BENCHMARKS[name]
+    size = scale_size(size, scale)
+    items = get_items(size)
+    timings = []
+    work_dir = None
+    try:
+        for attempt in range(repeat):
+            if work_dir is None or name not in REUSABLE:
+                if work_dir:
+                    shutil.rmtree(work_dir, ignore_errors = True)
+                work_dir = tempfile.mkdtemp(prefix = 'mdr-micro-')
+                prepare_work_dir(work_dir)
+                run, verify = setup(work_dir, spool_type, size)
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+            handled = verify()
+            if handled != items:
+                # a run which skipped its work would look like a speedup
+                raise RuntimeError(f'{name} has handled {handled} of {items} items')
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors = True)
+    return {
+        'params': dict(size, spool = spool_type),
+        'items': items,
+        'seconds': min(timings),
+        'median_seconds': statistics.median(timings),
+    }
+
+
+def load_baselines(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'benchmarks': {}}
+
+
+def save_baselines(path: str, baselines: Dict[str, Any], results: Dict[str, Dict[str, Any]]) -> None:
+    # the benchmarks which haven't been run keep their baselines
+    baselines['python'] = platform.python_version()
+    baselines['platform'] = platform.platform()
+    baselines['saved'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    for name, result in results.items():
+        baselines['benchmarks'][name] = {key: result[key] for key in ('params', 'items', 'seconds')}
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent = 2, sort_keys = True)
+        f.write('\n')
+
+
+def compare(result: Dict[str, Any], baseline: Optional[Dict[str, Any]], tolerance: float) -> Tuple[Optional[float], str]:
+    # relative change of the fastest run and the verdict
+    if not baseline:
+        return None, 'no baseline'
+    if baseline['params'] != result['params']:
+        return None, 'other fixture'
+    change = result['seconds'] / baseline['seconds'] - 1
+    if change > tolerance:
+        return change, 'REGRESSION'
+    if change < -tolerance:
+        return change, 'faster'
+    return change, 'ok'
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Microbenchmarks of the MDR sync, spool and sink hot paths')
+    parser.add_argument('--only', help = 'comma separated benchmark names or patterns, e.g. scan_folder,*process_updates')
+    parser.add_argument('--spool', choices = ['files', 'sqlite'], default = 'files', help = 'spool.type, default files')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'runs of every benchmark, the fastest one counts, default 5')
+    parser.add_argument('--scale', type = float, default = 1, help = 'multiplies the fixture sizes, default 1')
+    parser.add_argument('--tolerance', type = float, default = 0.3, help = 'allowed slowdown against the baseline, default 0.3 (30%%), the spool benchmarks depend on the disk')
+    parser.add_argument('--baselines', default = BASELINES, help = 'default bench/baselines.json')
+    parser.add_argument('--save', action = 'store_true', help = 'save the results as the new baselines')
+    parser.add_argument('--output', help = 'write the results as JSON to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level = logging.WARNING)
+    names = list(BENCHMARKS)
+    if args.only:
+        patterns = args.only.split(',')
+        names = [name for name in names if any(fnmatch.fnmatch(name, pattern.strip()) for pattern in patterns)]
+    baselines = load_baselines(args.baselines)
+    results = {}
+    regressions = []
+    print(f"{'benchmark':26} {'best':>10} {'median':>10} {'per item':>10} {'baseline':>10} {'change':>8}")
+    for name in names:
+        try:
+            result = run_benchmark(name, args.spool, args.scale, args.repeat)
+        except ImportError as e:
+            print(f'{name:26} skipped: {e}')
+            continue
+        baseline = baselines['benchmarks'].get(name)
+        change, verdict = compare(result, baseline, args.tolerance)
+        result.update(change = change, verdict = verdict)
+        results[name] = result
+        if verdict == 'REGRESSION':
+            regressions.append(name)
+        reference = f"{baseline['seconds'] * 1000:8.1f}ms" if change is not None else 'n/a'
+        print(
+            f"{name:26} {result['seconds'] * 1000:8.1f}ms {result['median_seconds'] * 1000:8.1f}ms {result['seconds'] / result['items'] * 1e6:8.1f}us "
+            f"{reference:>10} {'' if change is None else f'{change:+.0%}':>8} {verdict}"
+        )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+    if args.save:
+        save_baselines(args.baselines, baselines, results)
+        print(f'baselines saved to {args.baselines}')
+        return 0
+    if regressions:
+        print(f"slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
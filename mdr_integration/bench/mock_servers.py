@@ -0,0 +1,615 @@
+"""
+Local stand-ins of the MDR, KUMA and TheHive APIs for the benchmarks. Every server
+runs in a thread of the calling process on 127.0.0.1 and a free port.
+Example:
+scenario = Scenario(incidents = 1000, comments = 10, attachments = 1, attachment_size = 65536)
+mdr = MockMDR(scenario, client_id = 'bench', faults = Faults(latency = 0.05, error_rate = 0.01))
+mdr.start()
+mdr.url  # http://127.0.0.1:<port>, api_url of the config
+mdr.stop()
+"""
+
+import re
+import json
+import time
+import uuid
+import bisect
+import random
+import threading
+import jwt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Dict, Any, List, Tuple
+
+# the mock MDR signs its tokens, the clients never verify them
+TOKEN_KEY = 'mdr-integration-benchmark-token-key'
+
+
+class Faults():
+    """
+    latency - seconds added to every request, jitter - random seconds added on top of it
+    error_rate - share of the requests answered with error_code
+    """
+
+    def __init__(self, latency: float = 0, jitter: float = 0, error_rate: float = 0, error_code: int = 503) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+
+
+    def delay(self) -> None:
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+
+    def fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class Scenario():
+    """
+    Synthetic MDR incidents, generated on request. Incidents appear at arrival_rate
+    per second from the start, with arrival_rate = 0 all of them exist already.
+    An incident appears with all of its comments, attachments and responses, they are
+    all created in the millisecond after the incident, which is its update_time.
+    """
+
+    PRIORITIES = ['LOW', 'NORMAL', 'HIGH']
+
+    def __init__(self, incidents: int = 100, comments: int = 5, attachments: int = 1, responses: int = 1, hosts: int = 2, attachment_size: int = 65536, closed_ratio: float = 0, arrival_rate: float = 0) -> None:
+        self.incidents = incidents
+        self.comments = comments
+        self.attachments = attachments
+        self.responses = responses
+        self.hosts = hosts
+        self.attachment_size = attachment_size
+        self.closed_ratio = closed_ratio
+        self.arrival_rate = arrival_rate
+        self.reset()
+
+
+    def reset(self) -> None:
+        # Every incident gets its own update_time, so the pages of incidents/list are never cut inside a group.
+        # times are the update times, the incident is created in the millisecond before.
+        self.stride = 2
+        start = int(time.time() * 1000)
+        if not self.arrival_rate:
+            start -= self.incidents * self.stride
+        self.times = []
+        for number in range(self.incidents):
+            planned = start + (int(number * 1000 / self.arrival_rate) if self.arrival_rate else 0)
+            self.times.append(max(planned, self.times[-1] + self.stride if self.times else start + self.stride))
+
+
+    def expected_updates(self) -> int:
+        # MDRSync pushes new_incident and update_incident for an incident seen for the first time
+        return self.incidents * (2 + self.comments + self.attachments + self.responses)
+
+
+    def get_creation_time(self, number: int) -> int:
+        return self.times[number] - self.stride + 1
+
+
+    def visible(self, min_time: int = 0, max_time: Optional[int] = None) -> range:
+        # numbers of the incidents existing now with min_time <= update_time <= max_time
+        last = int(time.time() * 1000) + self.stride - 1
+        max_time = last if max_time is None else min(max_time, last)
+        return range(bisect.bisect_left(self.times, min_time), bisect.bisect_right(self.times, max_time))
+
+
+    def created(self, min_time: int = 0, max_time: Optional[int] = None) -> range:
+        # the same by creation time
+        return self.visible(min_time + self.stride - 1, None if max_time is None else max_time + self.stride - 1)
+
+
+    def get_number(self, incident_id: str) -> Optional[int]:
+        match = re.match(r'^bench-(\d+)$', incident_id or '')
+        if not match or int(match[1]) >= self.incidents:
+            return None
+        return int(match[1])
+
+
+    def get_incident(self, number: int, children: bool = True) -> Dict[str, Any]:
+        incident_id = f'bench-{number}'
+        update_time = self.times[number]
+        closed = number < self.incidents * self.closed_ratio
+        incident = {
+            'incident_id': incident_id,
+            'creation_time': self.get_creation_time(number),
+            'update_time': update_time,
+            'summary': f'Benchmark incident {number}',
+            'description': f'Synthetic incident {number} of the benchmark scenario',
+            'status': 'Closed' if closed else 'Open',
+            'status_description': 'Closed by the benchmark' if closed else '',
+            'resolution': 'True positive' if closed else '',
+            'priority': self.PRIORITIES[number % len(self.PRIORITIES)],
+            'tenant_name': 'benchmark',
+            'affected_hosts': [f'host-{number}-{host}' for host in range(self.hosts)],
+            'affected_hosts_mappings': [{'host_id': f'{number:016x}{host:016x}', 'host_name': f'host-{number}-{host}'} for host in range(self.hosts)],
+            'detection_technologies': ['EDR'],
+            'mitre_tactics': [],
+            'mitre_techniques': [],
+        }
+        if children:
+            incident['comments'] = self.get_comments(number)
+            incident['attachments'] = self.get_attachments(number)
+            incident['responses'] = self.get_responses(number)
+        return incident
+
+
+    def get_comments(self, number: int) -> List[Dict[str, Any]]:
+        return [
+            {
+                'comment_id': f'bench-{number}-comment-{comment}',
+                'author_name': 'MDR analyst',
+                'creation_time': self.get_creation_time(number) + 1,
+                'text': f'Comment {comment} of incident {number}',
+                'was_read': False
+            }
+            for comment in range(self.comments)
+        ]
+
+
+    def get_attachments(self, number: int) -> List[Dict[str, Any]]:
+        return [
+            {
+                'attachment_id': f'bench-{number}-attachment-{attachment}',
+                'author_name': 'MDR analyst',
+                'caption': f'Attachment {attachment} of incident {number}',
+                'creation_time': self.get_creation_time(number) + 1,
+                'file_size': self.attachment_size,
+                'full_name': f'evidence-{number}-{attachment}.bin',
+                'link': f'https://mdr.example/attachments/bench-{number}-attachment-{attachment}',
+                'origin': 'MDR',
+                'was_read': False
+            }
+            for attachment in range(self.attachments)
+        ]
+
+
+    def get_responses(self, number: int) -> List[Dict[str, Any]]:
+        return [
+            {
+                'response_id': f'bench-{number}-response-{response}',
+                'creation_time': self.get_creation_time(number) + 1,
+                'type': 'isolate_host',
+                'status': 'Waiting for confirmation',
+                'parameters': {'host_id': f'{number:016x}{response:016x}'},
+                'description': f'Response {response} of incident {number}'
+            }
+            for response in range(self.responses)
+        ]
+
+
+    def get_attachment_content(self, attachment_id: str) -> bytes:
+        # the content differs per attachment, so the attachment store doesn't deduplicate it
+        pattern = f'{attachment_id}\n'.encode()
+        return (pattern * (self.attachment_size // len(pattern) + 1))[:self.attachment_size]
+
+
+class MockServer():
+    """
+    Base of the mock servers: JSON over HTTP, faults and request counters per route.
+    Subclasses fill routes with (method, regex) -> handler(request) returning (code, body, headers).
+    """
+
+    # routes which never get injected faults
+    RELIABLE_ROUTES = ()
+
+    def __init__(self, faults: Optional[Faults] = None) -> None:
+        self.faults = faults or Faults()
+        self.routes = []
+        self.requests = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.httpd = None
+
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+
+    def route(self, method: str, pattern: str, handler: Any, name: str) -> None:
+        self.routes.append((method, re.compile(f'^{pattern}$'), handler, name))
+
+
+    def count(self, counters: Dict[str, int], name: str) -> None:
+        with self.lock:
+            counters[name] = counters.get(name, 0) + 1
+
+
+    def handle(self, method: str, path: str, headers: Any, body: bytes) -> Tuple[int, Any, Dict[str, str]]:
+        path, _, query = path.partition('?')
+        for route_method, pattern, handler, name in self.routes:
+            match = pattern.match(path)
+            if route_method != method or not match:
+                continue
+            self.count(self.requests, name)
+            self.faults.delay()
+            if name not in self.RELIABLE_ROUTES and self.faults.fail():
+                self.count(self.errors, name)
+                return self.faults.error_code, {'error': 'injected by the benchmark'}, {}
+            request = {'match': match, 'headers': headers, 'body': body, 'query': query}
+            return handler(request)
+        return 404, {'error': f'{method} {path} is not mocked'}, {}
+
+
+    def get_handler(self) -> Any:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, Nagle's algorithm would delay keep-alive responses
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.dispatch('GET')
+
+            def do_POST(self):
+                self.dispatch('POST')
+
+            def do_PATCH(self):
+                self.dispatch('PATCH')
+
+            def dispatch(self, method):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                try:
+                    code, result, headers = server.handle(method, self.path, self.headers, body)
+                except Exception as e:
+                    code, result, headers = 500, {'error': str(e)}, {}
+                if not isinstance(result, bytes):
+                    result = json.dumps(result).encode()
+                    headers = dict({'Content-Type': 'application/json'}, **headers)
+                self.send_response(code)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(result)))
+                self.end_headers()
+                self.wfile.write(result)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+    def start(self) -> None:
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.get_handler())
+        self.httpd.daemon_threads = True
+        threading.Thread(target = self.httpd.serve_forever, daemon = True).start()
+
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'requests': dict(self.requests), 'errors': dict(self.errors)}
+
+
+def load_json(request: Dict[str, Any]) -> Dict[str, Any]:
+    return json.loads(request['body'] or b'{}')
+
+
+def is_multipart(request: Dict[str, Any]) -> bool:
+    return (request['headers'].get('Content-Type') or '').split(';')[0].strip() == 'multipart/form-data'
+
+
+def project(document: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    if not fields:
+        return document
+    return {key: value for key, value in document.items() if key in fields}
+
+
+class MockMDR(MockServer):
+    """
+    The MDR endpoints used by MDRConsole: session/confirm, incidents/list, incidents/details,
+    incidents/history, comments/list, attachments/list, responses/list and attachments/download
+    with Range requests. Access tokens are JWTs living token_ttl seconds, refresh tokens are single-use.
+    """
+
+    RELIABLE_ROUTES = ('session/confirm',)
+
+    def __init__(self, scenario: Scenario, client_id: str = 'bench', token_ttl: int = 3600, faults: Optional[Faults] = None) -> None:
+        super().__init__(faults)
+        self.scenario = scenario
+        self.client_id = client_id
+        self.token_ttl = token_ttl
+        self.refresh_tokens = set()
+        self.access_tokens = {}
+        # MDRSync has asked for the changes after the last incident, so it has got all of them
+        self.drained = False
+        for name, handler in (
+            ('session/confirm', self.session_confirm),
+            ('incidents/list', self.incidents_list),
+            ('incidents/details', self.incidents_details),
+            ('incidents/history', self.incidents_history),
+            ('comments/list', self.comments_list),
+            ('attachments/list', self.attachments_list),
+            ('responses/list', self.responses_list),
+            ('attachments/download', self.attachments_download),
+        ):
+            self.route('POST', f'/{re.escape(client_id)}/{name}', self.authorized(handler, name), name)
+
+
+    def issue_refresh_token(self) -> str:
+        token = jwt.encode({'exp': int(time.time()) + 86400, 'jti': uuid.uuid4().hex}, TOKEN_KEY, algorithm = 'HS256')
+        with self.lock:
+            self.refresh_tokens.add(token)
+        return token
+
+
+    def authorized(self, handler: Any, name: str) -> Any:
+        def check(request):
+            if name != 'session/confirm':
+                token = (request['headers'].get('Authorization') or '')[len('Bearer '):]
+                with self.lock:
+                    exp = self.access_tokens.get(token)
+                if exp is None or exp <= time.time():
+                    self.count(self.errors, '401')
+                    return 401, {'error': 'access token is invalid or expired'}, {}
+            return handler(request)
+        return check
+
+
+    def session_confirm(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        refresh_token = load_json(request).get('refresh_token', '').strip()
+        with self.lock:
+            if refresh_token not in self.refresh_tokens:
+                return 401, {'error': 'refresh token is invalid or used'}, {}
+            self.refresh_tokens.discard(refresh_token)
+        exp = int(time.time()) + self.token_ttl
+        access_token = jwt.encode({'exp': exp, 'jti': uuid.uuid4().hex}, TOKEN_KEY, algorithm = 'HS256')
+        with self.lock:
+            self.access_tokens[access_token] = exp
+        return 200, {'access_token': access_token, 'refresh_token': self.issue_refresh_token()}, {}
+
+
+    def incidents_list(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        params = load_json(request)
+        if self.scenario.incidents and params.get('min_update_time', 0) > self.scenario.times[-1]:
+            self.drained = True
+        numbers = self.scenario.visible(params.get('min_update_time', 0), params.get('max_update_time'))
+        page_size = params.get('page_size', 100)
+        page = params.get('page', 1)
+        fields = params.get('fields')
+        children = not fields or bool({'comments', 'attachments', 'responses'} & set(fields))
+        result = []
+        for number in numbers[(page - 1) * page_size:page * page_size]:
+            incident = self.scenario.get_incident(number, children = children)
+            if 'statuses' in params and incident['status'] not in params['statuses']:
+                continue
+            if 'priorities' in params and incident['priority'] not in params['priorities']:
+                continue
+            result.append(project(incident, fields))
+        return 200, result, {}
+
+
+    def get_visible_number(self, incident_id: str) -> Optional[int]:
+        number = self.scenario.get_number(incident_id)
+        if number is None or self.scenario.get_creation_time(number) > time.time() * 1000:
+            return None
+        return number
+
+
+    def incidents_details(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        params = load_json(request)
+        number = self.get_visible_number(params.get('incident_id'))
+        if number is None:
+            return 404, {'error': 'incident not found'}, {}
+        return 200, project(self.scenario.get_incident(number), params.get('fields')), {}
+
+
+    def incidents_history(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        params = load_json(request)
+        page_size = params.get('entity_type_page_size', 100)
+        page = params.get('page', 1)
+        if self.scenario.incidents and params.get('min_record_time', 0) > self.scenario.get_creation_time(self.scenario.incidents - 1):
+            self.drained = True
+        history = {'incidents': [], 'comments': [], 'attachments': [], 'responses': []}
+        # the records of an incident are reported at its creation, when all of its children exist
+        for number in self.scenario.created(params.get('min_record_time', 0), params.get('max_record_time')):
+            record = {'incident_id': f'bench-{number}', 'record_time': self.scenario.get_creation_time(number)}
+            history['incidents'].append(record)
+            history['comments'].extend([record] * self.scenario.comments)
+            history['attachments'].extend([record] * self.scenario.attachments)
+            history['responses'].extend([record] * self.scenario.responses)
+        return 200, {key: records[(page - 1) * page_size:page * page_size] for key, records in history.items()}, {}
+
+
+    def list_children(self, request: Dict[str, Any], get_children: Any) -> Tuple[int, Any, Dict[str, str]]:
+        params = load_json(request)
+        number = self.get_visible_number(params.get('incident_id'))
+        if number is None:
+            return 404, {'error': 'incident not found'}, {}
+        min_creation_time = params.get('min_creation_time', 0)
+        return 200, [project(child, params.get('fields')) for child in get_children(number) if child['creation_time'] >= min_creation_time], {}
+
+
+    def comments_list(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        return self.list_children(request, self.scenario.get_comments)
+
+
+    def attachments_list(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        return self.list_children(request, self.scenario.get_attachments)
+
+
+    def responses_list(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        return self.list_children(request, self.scenario.get_responses)
+
+
+    def attachments_download(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        content = self.scenario.get_attachment_content(load_json(request).get('attachment_id', ''))
+        match = re.match(r'^bytes=(\d+)-$', request['headers'].get('Range') or '')
+        if match and int(match[1]) < len(content):
+            offset = int(match[1])
+            return 206, content[offset:], {'Content-Type': 'application/octet-stream', 'Content-Range': f'bytes {offset}-{len(content) - 1}/{len(content)}'}
+        return 200, content, {'Content-Type': 'application/octet-stream'}
+
+
+class MockKUMA(MockServer):
+    """
+    KUMA /api/v2.1/incidents/create, /incidents/comment and /incidents/close.
+    """
+
+    def __init__(self, faults: Optional[Faults] = None) -> None:
+        super().__init__(faults)
+        self.incidents = {}
+        self.route('POST', '/api/v2.1/incidents/create', self.create, 'incidents/create')
+        self.route('POST', '/api/v2.1/incidents/comment', self.comment, 'incidents/comment')
+        self.route('POST', '/api/v2.1/incidents/close', self.close, 'incidents/close')
+
+
+    def create(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        incident = load_json(request)
+        incident_id = str(uuid.uuid4())
+        with self.lock:
+            self.incidents[incident_id] = {'name': incident.get('name'), 'comments': 0, 'closed': False}
+        return 200, {'id': incident_id, 'name': incident.get('name')}, {}
+
+
+    def comment(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        params = load_json(request)
+        with self.lock:
+            incident = self.incidents.get(params.get('id'))
+            if incident is None:
+                return 404, {'error': 'incident not found'}, {}
+            incident['comments'] += 1
+        return 200, {'id': params['id']}, {}
+
+
+    def close(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        params = load_json(request)
+        with self.lock:
+            incident = self.incidents.get(params.get('id'))
+            if incident is None:
+                return 404, {'error': 'incident not found'}, {}
+            incident['closed'] = True
+        return 200, {'id': params['id']}, {}
+
+
+def get_field(document: Dict[str, Any], field: str) -> Any:
+    for key in field.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def match_query(document: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    # the subset of the TheHive query language built by thehive4py.query and used by the sink
+    if not query:
+        return True
+    if '_and' in query:
+        return all(match_query(document, criterion) for criterion in query['_and'])
+    if '_or' in query:
+        return any(match_query(document, criterion) for criterion in query['_or'])
+    if '_not' in query:
+        return not match_query(document, query['_not'])
+    if '_field' in query:
+        return get_field(document, query['_field']) == query['_value']
+    if '_in' in query:
+        return get_field(document, query['_in']['_field']) in query['_in']['_values']
+    if '_id' in query:
+        return document.get('id') == query['_id']
+    if '_parent' in query:
+        parent = query['_parent']
+        if '_id' in parent:
+            return document.get('_parent') == parent['_id']
+        return match_query({'id': document.get('_parent')}, parent.get('_query'))
+    raise ValueError(f'unsupported query {query}')
+
+
+class MockTheHive(MockServer):
+    """
+    TheHive 3/4 case API used through thehive4py: cases, case search, tasks, task search,
+    task logs (JSON and multipart with a file) and observables (single and multi-value).
+    """
+
+    def __init__(self, faults: Optional[Faults] = None) -> None:
+        super().__init__(faults)
+        self.cases = {}
+        self.tasks = {}
+        self.logs = 0
+        self.observables = 0
+        self.route('POST', '/api/case', self.create_case, 'case/create')
+        self.route('POST', '/api/case/_search', self.find_cases, 'case/_search')
+        self.route('POST', '/api/case/task/_search', self.find_tasks, 'case/task/_search')
+        self.route('POST', r'/api/case/task/(?P<task_id>[^/]+)/log', self.create_task_log, 'case/task/log')
+        self.route('POST', r'/api/case/(?P<case_id>[^/]+)/task', self.create_task, 'case/task')
+        self.route('POST', r'/api/case/(?P<case_id>[^/]+)/artifact', self.create_observable, 'case/artifact')
+        self.route('PATCH', r'/api/case/(?P<case_id>[^/]+)', self.update_case, 'case/update')
+
+
+    def add_task(self, case_id: str, task: Dict[str, Any]) -> Dict[str, Any]:
+        task = dict(task, id = uuid.uuid4().hex, _parent = case_id)
+        self.tasks[task['id']] = task
+        return task
+
+
+    def create_case(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        case = load_json(request)
+        case['id'] = uuid.uuid4().hex
+        case['createdAt'] = int(time.time() * 1000)
+        with self.lock:
+            tasks = [self.add_task(case['id'], task) for task in case.pop('tasks', None) or []]
+            self.cases[case['id']] = case
+        return 201, dict(case, tasks = tasks), {}
+
+
+    def update_case(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        case_id = request['match']['case_id']
+        with self.lock:
+            case = self.cases.get(case_id)
+            if case is None:
+                return 404, {'type': 'NotFoundError', 'message': f'case {case_id} not found'}, {}
+            case.update(load_json(request))
+            return 200, dict(case), {}
+
+
+    def search(self, request: Dict[str, Any], records: Dict[str, Dict[str, Any]]) -> Tuple[int, Any, Dict[str, str]]:
+        query = load_json(request).get('query') or {}
+        with self.lock:
+            return 200, [record for record in records.values() if match_query(record, query)], {}
+
+
+    def find_cases(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        return self.search(request, self.cases)
+
+
+    def find_tasks(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        return self.search(request, self.tasks)
+
+
+    def create_task(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        case_id = request['match']['case_id']
+        with self.lock:
+            if case_id not in self.cases:
+                return 404, {'type': 'NotFoundError', 'message': f'case {case_id} not found'}, {}
+            return 201, self.add_task(case_id, load_json(request)), {}
+
+
+    def create_task_log(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        task_id = request['match']['task_id']
+        with self.lock:
+            if task_id not in self.tasks:
+                return 404, {'type': 'NotFoundError', 'message': f'task {task_id} not found'}, {}
+            self.logs += 1
+        # multipart logs carry the file, its content isn't kept
+        message = '' if is_multipart(request) else load_json(request).get('message')
+        return 201, {'id': uuid.uuid4().hex, 'message': message}, {}
+
+
+    def create_observable(self, request: Dict[str, Any]) -> Tuple[int, Any, Dict[str, str]]:
+        case_id = request['match']['case_id']
+        observable = {} if is_multipart(request) else load_json(request)
+        values = observable.get('data') if isinstance(observable.get('data'), list) else [observable.get('data')]
+        with self.lock:
+            if case_id not in self.cases:
+                return 404, {'type': 'NotFoundError', 'message': f'case {case_id} not found'}, {}
+            self.observables += len(values)
+        return 201, [dict(observable, id = uuid.uuid4().hex, data = value) for value in values], {}
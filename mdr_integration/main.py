@@ -6,15 +6,20 @@ import time
 import logging
 import logging.config
 import logging.handlers
+import functools
 import multiprocessing
 
 
 #from src.mdr_api import MDRConsole
 from src.token_updater import TokenUpdater
 from src.mdr_sync import MDRSync
+from src.attachment_downloader import AttachmentDownloader
+from src.spool_compactor import SpoolCompactor
 from src.integration_kuma import KUMA
 #from src.integration_thehive import TheHive
-from src.logger import MDRLogger
+from src.logger import MDRLogger, configure_process
+from src import metrics
+from src.metrics import MetricsServer
 
 WORK_DIR = os.path.dirname(os.path.abspath(__file__))
 with open(f'{WORK_DIR}/conf/config.yml', 'r') as f:
@@ -30,16 +35,15 @@ for temp_file in temp_files:
         open(f"{config['data_dir']}/{temp_file}", 'w').close()
 
 
-def process_logging_configurer(queue):
-    h = logging.handlers.QueueHandler(queue)  # Just the one handler needed
-    root = logging.getLogger()
-    root.addHandler(h)
-    root.setLevel(logging.DEBUG)
+def process_logging_configurer(queue, metrics_queue = None):
+    # non-blocking: records are filtered by level and repeats in the process, dropped if the queue is full
+    configure_process(queue, config['logging'])
+    metrics.configure(metrics_queue, flush_interval = (config.get('metrics') or {}).get('flush_interval', 5))
 
 def main():
     # Init Logger
     logging_config = config.get('logging')
-    logging_queue = multiprocessing.Queue(-1)
+    logging_queue = multiprocessing.Queue(logging_config.get('queue_size', 10000))
     mdr_logger = MDRLogger()
     logging_listener = multiprocessing.Process(target=mdr_logger.run, args=(logging_queue, logging_config))
     logging_listener.start()
@@ -48,22 +52,35 @@ def main():
     logger = logging.getLogger(__name__)
     logger.info('MDR Integration service is starting..')
 
+    # Child processes send their metrics to main.py
+    metrics_config = config.get('metrics') or {}
+    metrics_queue = multiprocessing.Queue(1000) if metrics_config.get('enabled', True) else None
+    process_configurer = functools.partial(process_logging_configurer, metrics_queue = metrics_queue)
+
     # Run automatic token updater
     token_updater = TokenUpdater(config)
-    process_token_updater = multiprocessing.Process(target = token_updater.run, args=(logging_queue, process_logging_configurer))
+    process_token_updater = multiprocessing.Process(target = token_updater.run, args=(logging_queue, process_configurer), name = 'token_updater')
 
     mdr_sync = MDRSync(config)
-    process_mdr_sync = multiprocessing.Process(target = mdr_sync.run, args=(logging_queue, process_logging_configurer))
+    process_mdr_sync = multiprocessing.Process(target = mdr_sync.run, args=(logging_queue, process_configurer), name = 'mdr_sync')
+
+    attachment_downloader = AttachmentDownloader(config)
+    process_attachment_downloader = multiprocessing.Process(target = attachment_downloader.run, args=(logging_queue, process_configurer), name = 'attachment_downloader')
+
+    spool_compactor = SpoolCompactor(config)
+    process_spool_compactor = multiprocessing.Process(target = spool_compactor.run, args=(logging_queue, process_configurer), name = 'spool_compactor')
 
     kuma_intergation = KUMA(config)
-    process_kuma_intergation = multiprocessing.Process(target = kuma_intergation.run, args=(logging_queue, process_logging_configurer))
+    process_kuma_intergation = multiprocessing.Process(target = kuma_intergation.run, args=(logging_queue, process_configurer), name = 'kuma')
 
     #the_hive = TheHive(config)
-    #process_the_hive = multiprocessing.Process(target = the_hive.run)
+    #process_the_hive = multiprocessing.Process(target = the_hive.run, args=(logging_queue, process_configurer), name = 'thehive')
 
     process_token_updater.start()
     time.sleep(5)
     process_mdr_sync.start()
+    process_attachment_downloader.start()
+    process_spool_compactor.start()
     time.sleep(5)
     process_kuma_intergation.start()
     time.sleep(5)
@@ -71,5 +88,22 @@ def main():
 
     logger.info('MDR Integration service started..')
 
+    # main.py keeps serving /metrics, /healthz and /readyz
+    if metrics_queue is not None:
+        metrics_server = MetricsServer(
+            metrics_queue,
+            host = metrics_config.get('host', '127.0.0.1'),
+            port = metrics_config.get('port', 9108),
+            grace = metrics_config.get('grace', 60),
+            window = metrics_config.get('window', 10000)
+        )
+        metrics_server.watch('token_updater', process_token_updater)
+        metrics_server.watch('mdr_sync', process_mdr_sync)
+        metrics_server.watch('attachment_downloader', process_attachment_downloader)
+        metrics_server.watch('spool_compactor', process_spool_compactor)
+        metrics_server.watch('kuma', process_kuma_intergation)
+        #metrics_server.watch('thehive', process_the_hive)
+        metrics_server.serve_forever()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
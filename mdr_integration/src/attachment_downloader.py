@@ -0,0 +1,154 @@
+import os
+import glob
+import json
+import time
+import logging
+import concurrent.futures
+from typing import Optional, Dict, Any, List
+
+from src.mdr_api import MDRConsole
+from src.token_broker import TokenClient
+from src import metrics
+from src.spool import get_spool
+from src.blob_store import get_blob_store
+
+
+class AttachmentDownloader():
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        api_url = config.get('api_url')
+        client_id = config.get('client_id')
+        ssl_cert = config.get('ssl_cert', False)
+        downloader_config = config.get('attachment_downloader') or {}
+        self.period = downloader_config.get('period', 5)
+        self.workers = downloader_config.get('workers', 4)
+        self.chunk_size = downloader_config.get('chunk_size', 1048576)
+        self.max_attempts = downloader_config.get('max_attempts', 5)
+        self.evict_period = downloader_config.get('evict_period', 3600)
+        self.size_limit = config['mdr_sync'].get('download_attachments_size_limit')
+        self.data_dir = config.get('data_dir', 'data')
+        self.token_dir = config.get('token_dir', 'conf')
+        self.files_dir = f'{self.data_dir}/files'
+        self.queue_dir = get_queue_dir(self.data_dir)
+        os.makedirs(self.queue_dir, exist_ok = True)
+        self.store = get_blob_store(config)
+        self.spool = get_spool(config)
+        self.token_client = TokenClient(self.token_dir)
+        self.mdr = MDRConsole(api_url = api_url, client_id = client_id, ssl_cert = ssl_cert, http = config.get('http'), token_provider = self.token_client.get)
+
+
+    def update_access_token(self) -> str:
+        return self.token_client.get()
+
+
+    def scan_queue(self) -> List[str]:
+        return sorted(glob.glob(f'{self.queue_dir}/*.json'))
+
+
+    def download(self, job_file: str) -> None:
+        with open(job_file, 'r') as f:
+            job = json.load(f)
+        attachment = job['data']['attachments'][0]
+        attachment_id = attachment['attachment_id']
+        filename = attachment['full_name']
+        part_path = f'{self.files_dir}/{attachment_id}.part'
+        try:
+            if self.store.contains(attachment_id):
+                self.logger.info(f'file {filename} is already in the attachment store')
+            elif self.stream_to_file(attachment_id, part_path):
+                blob_hash = self.store.add(attachment_id, filename, part_path)
+                self.logger.info(f'file {filename} has been written to the attachment store: {blob_hash}')
+                metrics.inc('attachment_downloads_total', result = 'downloaded')
+            else:
+                self.logger.warning(f'file {filename} exceeds download_attachments_size_limit {self.size_limit} and has not been downloaded')
+        except Exception as e:
+            job['attempts'] = job.get('attempts', 0) + 1
+            if job['attempts'] < self.max_attempts:
+                self.logger.exception(f'Error while downloading attachment {attachment_id}, attempt {job["attempts"]}')
+                write_job(job_file, job)
+                metrics.inc('attachment_downloads_total', result = 'retry')
+                return
+            # the sinks fall back to the attachment link
+            self.logger.exception(f'Attachment {attachment_id} has not been downloaded after {job["attempts"]} attempts')
+            metrics.inc('attachment_downloads_total', result = 'failed')
+            self.remove(part_path)
+        self.spool.push('new_attachment', job['timestamp'], job['data'])
+        os.remove(job_file)
+
+
+    def stream_to_file(self, attachment_id: str, part_path: str) -> bool:
+        # resume a partial download
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        resp = self.mdr.attachments_download_stream(attachment_id = attachment_id, offset = offset)
+        try:
+            if resp.status_code != 206:
+                # the whole file is sent again
+                offset = 0
+            written = offset
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in resp.iter_content(chunk_size = self.chunk_size):
+                    written += len(chunk)
+                    if self.size_limit is not None and written > self.size_limit:
+                        break
+                    f.write(chunk)
+        finally:
+            resp.close()
+        if self.size_limit is not None and written > self.size_limit:
+            self.remove(part_path)
+            return False
+        return True
+
+
+    def remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+    def run(self, logging_queue, logging_configurer) -> None:
+        logging_configurer(logging_queue)
+        self.logger = logging.getLogger(__name__)
+        self.logger.info('started')
+        in_progress = {}
+        last_evict = 0
+        metrics.set_ready()
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers) as executor:
+            while True:
+                if time.time() - last_evict > self.evict_period:
+                    self.logger.info(f'attachment store eviction: {self.store.evict()}')
+                    last_evict = time.time()
+                self.mdr.access_token = self.update_access_token()
+                for job_file in self.scan_queue():
+                    if job_file not in in_progress:
+                        in_progress[job_file] = executor.submit(self.download, job_file)
+                metrics.set_gauge('attachment_downloads_in_progress', len(in_progress))
+                metrics.heartbeat(self.period)
+                time.sleep(self.period)
+                for job_file, future in list(in_progress.items()):
+                    if future.done():
+                        if future.exception():
+                            self.logger.error(f'Download job {job_file} failed: {future.exception()}')
+                        del in_progress[job_file]
+
+
+def get_queue_dir(data_dir: str) -> str:
+    return f'{data_dir}/files/queue'
+
+
+def write_job(job_file: str, job: Dict[str, Any]) -> None:
+    tmp_path = f'{job_file}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, job_file)
+
+
+def enqueue_download(data_dir: str, timestamp: int, attachment_data: Dict[str, Any]) -> str:
+    """
+    Schedules the download of the attachment, the new_attachment update is pushed
+    to the spool once the file is stored.
+    """
+    attachment_id = attachment_data['attachments'][0]['attachment_id']
+    job_file = f'{get_queue_dir(data_dir)}/{attachment_id}.json'
+    write_job(job_file, {'timestamp': timestamp, 'data': attachment_data})
+    return job_file
@@ -0,0 +1,145 @@
+import os
+import time
+import sqlite3
+import hashlib
+import contextlib
+from typing import Optional, Dict, Any, Tuple
+
+
+class BlobStore():
+    """
+    Content-addressed store of downloaded attachments. Every file is kept once
+    under its sha256 in {root}/blobs/ab/abcdef..., and the index maps MDR
+    attachment ids to the blobs. A blob is removed when no attachment refers to it.
+    """
+
+    def __init__(self, root: str, max_size: Optional[int] = None, max_age: Optional[int] = None) -> None:
+        """
+        max_size - bytes, the least recently used blobs are evicted above it
+        max_age - seconds, attachments older than that are evicted
+        """
+        self.root = root
+        self.blobs_dir = f'{root}/blobs'
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(self.blobs_dir, exist_ok = True)
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER, ref_count INTEGER, last_used REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS attachments (attachment_id TEXT PRIMARY KEY, hash TEXT, filename TEXT, created REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS attachments_hash ON attachments (hash)')
+            conn.execute('CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used)')
+
+
+    @contextlib.contextmanager
+    def connect(self):
+        # short-lived connections, the store is shared by threads and processes
+        conn = sqlite3.connect(f'{self.blobs_dir}/index.db', timeout = 30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+    def get_blob_path(self, blob_hash: str) -> str:
+        return f'{self.blobs_dir}/{blob_hash[:2]}/{blob_hash}'
+
+
+    def hash_file(self, path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+    def contains(self, attachment_id: str) -> bool:
+        with self.connect() as conn:
+            row = conn.execute('SELECT 1 FROM attachments WHERE attachment_id = ?', (attachment_id,)).fetchone()
+        return row is not None
+
+
+    def add(self, attachment_id: str, filename: str, path: str) -> str:
+        # moves the file into the store, the file is dropped if the same content is already stored
+        blob_hash = self.hash_file(path)
+        blob_path = self.get_blob_path(blob_hash)
+        size = os.path.getsize(path)
+        with self.connect() as conn:
+            if conn.execute('SELECT 1 FROM attachments WHERE attachment_id = ?', (attachment_id,)).fetchone():
+                os.remove(path)
+                return blob_hash
+            if os.path.exists(blob_path):
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok = True)
+                os.replace(path, blob_path)
+            conn.execute(
+                'INSERT INTO blobs (hash, size, ref_count, last_used) VALUES (?, ?, 1, ?) '
+                'ON CONFLICT(hash) DO UPDATE SET ref_count = ref_count + 1, last_used = excluded.last_used',
+                (blob_hash, size, time.time())
+            )
+            conn.execute('INSERT INTO attachments (attachment_id, hash, filename, created) VALUES (?, ?, ?, ?)', (attachment_id, blob_hash, filename, time.time()))
+        return blob_hash
+
+
+    def resolve(self, attachment_id: str) -> Optional[Tuple[str, str]]:
+        # path of the blob and the original filename of the attachment
+        with self.connect() as conn:
+            row = conn.execute('SELECT hash, filename FROM attachments WHERE attachment_id = ?', (attachment_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE blobs SET last_used = ? WHERE hash = ?', (time.time(), row[0]))
+        blob_path = self.get_blob_path(row[0])
+        if not os.path.exists(blob_path):
+            return None
+        return blob_path, row[1]
+
+
+    def release(self, attachment_id: str) -> None:
+        with self.connect() as conn:
+            self._release(conn, attachment_id)
+
+
+    def _release(self, conn: sqlite3.Connection, attachment_id: str) -> None:
+        row = conn.execute('SELECT hash FROM attachments WHERE attachment_id = ?', (attachment_id,)).fetchone()
+        if row is None:
+            return
+        conn.execute('DELETE FROM attachments WHERE attachment_id = ?', (attachment_id,))
+        conn.execute('UPDATE blobs SET ref_count = ref_count - 1 WHERE hash = ?', (row[0],))
+        if conn.execute('SELECT ref_count FROM blobs WHERE hash = ?', (row[0],)).fetchone()[0] <= 0:
+            conn.execute('DELETE FROM blobs WHERE hash = ?', (row[0],))
+            try:
+                os.remove(self.get_blob_path(row[0]))
+            except FileNotFoundError:
+                pass
+
+
+    def evict(self) -> Dict[str, int]:
+        evicted = 0
+        with self.connect() as conn:
+            if self.max_age is not None:
+                expired = conn.execute('SELECT attachment_id FROM attachments WHERE created < ?', (time.time() - self.max_age,)).fetchall()
+                for (attachment_id,) in expired:
+                    self._release(conn, attachment_id)
+                    evicted += 1
+            if self.max_size is not None:
+                total_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+                blobs = conn.execute('SELECT hash, size FROM blobs ORDER BY last_used').fetchall()
+                for blob_hash, size in blobs:
+                    if total_size <= self.max_size:
+                        break
+                    for (attachment_id,) in conn.execute('SELECT attachment_id FROM attachments WHERE hash = ?', (blob_hash,)).fetchall():
+                        self._release(conn, attachment_id)
+                        evicted += 1
+                    total_size -= size
+        return {'evicted': evicted}
+
+
+def get_blob_store(config: Dict[str, Any]) -> BlobStore:
+    store_config = config.get('attachment_store') or {}
+    return BlobStore(
+        root = f"{config.get('data_dir', 'data')}/files",
+        max_size = store_config.get('max_size'),
+        max_age = store_config.get('max_age')
+    )
@@ -0,0 +1,143 @@
+import time
+import logging
+import concurrent.futures
+from typing import Optional, Dict, Any, List, Callable
+
+from src import metrics
+
+
+class UpdateDispatcher():
+    """
+    Delivers a batch of spool updates to a sink. Updates are sharded by incident_id:
+    updates of one incident are handled one by one in timestamp and update type order,
+    different incidents are handled in parallel by the worker pool. When an update
+    fails, the rest of its incident is released, so a comment is never delivered
+    before the incident it belongs to.
+    update_incident updates carry the whole incident, so only the latest one of an
+    incident is delivered, the older ones are acked as superseded. The latest one is
+    held until it has been in the spool for settle_delay seconds. The local written_at
+    of the spool is used, the timestamp is the update_time of MDR, its clock may differ.
+    When an update is acked, the stages of its _trace (see MDRSync.add_trace) are
+    reported as update_latency_seconds quantiles per sink, update type and stage:
+    fetch - from the MDR event to the MDR request, write - until the update is written
+    to the spool (attachments include the download), delivery - until the sink accepted
+    it, total - from the MDR event to the delivery.
+    """
+
+    # updates of the same timestamp are delivered in this order
+    UPDATE_ORDER = {
+        'new_incident': 0,
+        'update_incident': 1,
+        'new_attachment': 2,
+        'new_comment': 2,
+        'new_response': 2
+    }
+
+    def __init__(self, spool: Any, handlers: Dict[str, Callable[[Dict[str, Any]], bool]], workers: int = 4, coalesce: bool = True, settle_delay: float = 0, sink: Optional[str] = None) -> None:
+        """
+        sink - name of the sink in the metrics
+        """
+        self.spool = spool
+        self.sink = sink
+        self.handlers = handlers
+        self.workers = workers
+        self.coalesce = coalesce
+        self.settle_delay = settle_delay
+        self.logger = logging.getLogger(__name__)
+
+
+    def get_shards(self, updates: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        shards = {}
+        for update in updates:
+            # updates without incident_id aren't ordered against anything
+            key = update['incident_id'] or f"#{update['id']}"
+            shards.setdefault(key, []).append(update)
+        return [
+            sorted(shard, key = lambda update: (update['timestamp'], self.UPDATE_ORDER.get(update['update_type'], len(self.UPDATE_ORDER))))
+            for shard in shards.values()
+        ]
+
+
+    def coalesce_shard(self, shard: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # the shard is ordered, so the last update_incident is the latest snapshot
+        incident_updates = [update for update in shard if update['update_type'] == 'update_incident']
+        superseded = incident_updates[:-1]
+        for update in superseded:
+            self.spool.ack(update)
+        if superseded:
+            self.logger.info(f"{len(superseded)} update_incident update(s) of incident {shard[0]['incident_id']} are superseded")
+        return [update for update in shard if not any(update is old for old in superseded)]
+
+
+    def process_shard(self, shard: List[Dict[str, Any]]) -> Dict[str, int]:
+        stats = {'processed': 0, 'failed': 0, 'skipped': 0, 'coalesced': 0, 'held': 0}
+        if self.coalesce:
+            coalesced = self.coalesce_shard(shard)
+            stats['coalesced'] = len(shard) - len(coalesced)
+            shard = coalesced
+        for number, update in enumerate(shard):
+            if update['update_type'] == 'update_incident' and update.get('written_at', 0) > time.time() - self.settle_delay:
+                # the incident is still being changed, the rest of the incident waits for it
+                for pending in shard[number:]:
+                    self.spool.release(pending)
+                stats['held'] += len(shard) - number
+                break
+            handler = self.handlers.get(update['update_type'])
+            if handler is None:
+                # update types the sink doesn't deliver don't block the incident
+                self.spool.release(update)
+                stats['skipped'] += 1
+                continue
+            started = time.monotonic()
+            try:
+                delivered = handler(update['data'])
+            except Exception as e:
+                self.logger.exception(f"{update['update_type']} update of incident {update['incident_id']} has failed")
+                delivered = False
+            metrics.observe('sink_delivery_seconds', time.monotonic() - started, sink = self.sink, update_type = update['update_type'])
+            if delivered:
+                self.spool.ack(update)
+                self.record_latency(update)
+                stats['processed'] += 1
+                continue
+            for pending in shard[number:]:
+                self.spool.release(pending)
+            stats['failed'] += len(shard) - number
+            break
+        return stats
+
+
+    def record_latency(self, update: Dict[str, Any]) -> None:
+        trace = update['data'].get('_trace')
+        if not trace:
+            return
+        delivered_at = time.time()
+        stages = {
+            'fetch': trace['fetched_at'] - trace['event_time'],
+            'write': trace['written_at'] - trace['fetched_at'],
+            'delivery': delivered_at - trace['written_at'],
+            'total': delivered_at - trace['event_time']
+        }
+        for stage, value in stages.items():
+            metrics.sample('update_latency_seconds', max(value, 0), sink = self.sink, update_type = update['update_type'], stage = stage)
+
+
+    def dispatch(self, updates: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Returns the number of processed, failed (released, including the updates
+        blocked by a failed one), skipped, coalesced and held updates.
+        Example:
+        {'processed': 10, 'failed': 2, 'skipped': 0, 'coalesced': 3, 'held': 1}
+        """
+        stats = {'processed': 0, 'failed': 0, 'skipped': 0, 'coalesced': 0, 'held': 0}
+        shards = self.get_shards(updates)
+        if not shards:
+            return stats
+        with concurrent.futures.ThreadPoolExecutor(max_workers = min(self.workers, len(shards))) as executor:
+            for shard_stats in executor.map(self.process_shard, shards):
+                for key, value in shard_stats.items():
+                    stats[key] += value
+        for key, value in stats.items():
+            if value:
+                metrics.inc('sink_updates_total', value, sink = self.sink, result = key)
+        return stats
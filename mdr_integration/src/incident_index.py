@@ -0,0 +1,96 @@
+import json
+import time
+import sqlite3
+import threading
+import contextlib
+import collections
+from typing import Optional, Dict, Any, Callable
+
+
+class IncidentIndex():
+    """
+    Persistent map from MDR incident_id to the ids of the objects a sink created
+    for it, e.g. {"case_id": "...", "task_id": "..."}. The entries are kept in SQLite
+    with an in-memory LRU cache in front of it, both are limited to max_entries.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, pin: Optional[Callable[[Dict[str, Any]], bool]] = None) -> None:
+        """
+        pin - pinned entries are never evicted from SQLite and don't count against max_entries,
+        e.g. ids of sink objects which can't be looked up again
+        Example:
+        IncidentIndex('data/kuma_index.db', pin = lambda entry: not entry.get('closed'))
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.pin = pin
+        self.cache = collections.OrderedDict()
+        # the index is shared by the dispatcher threads
+        self.lock = threading.RLock()
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries (incident_id TEXT PRIMARY KEY, data TEXT, last_used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+            if 'pinned' not in [column[1] for column in conn.execute('PRAGMA table_info(entries)')]:
+                # entries of older versions are kept until they are set again
+                conn.execute('ALTER TABLE entries ADD COLUMN pinned INTEGER NOT NULL DEFAULT 1')
+
+
+    @contextlib.contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout = 30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+    def cache_put(self, incident_id: str, entry: Dict[str, Any]) -> None:
+        with self.lock:
+            self.cache[incident_id] = entry
+            self.cache.move_to_end(incident_id)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last = False)
+
+
+    def get(self, incident_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.cache.get(incident_id)
+            if entry is not None:
+                self.cache.move_to_end(incident_id)
+                return entry
+        with self.connect() as conn:
+            row = conn.execute('SELECT data FROM entries WHERE incident_id = ?', (incident_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE entries SET last_used = ? WHERE incident_id = ?', (time.time(), incident_id))
+        entry = json.loads(row[0])
+        self.cache_put(incident_id, entry)
+        return entry
+
+
+    def set(self, incident_id: str, **values) -> Dict[str, Any]:
+        # values are merged into the existing entry
+        with self.lock:
+            entry = dict(self.get(incident_id) or {})
+            entry.update(values)
+            with self.connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO entries (incident_id, data, last_used, pinned) VALUES (?, ?, ?, ?)',
+                    (incident_id, json.dumps(entry), time.time(), int(bool(self.pin and self.pin(entry))))
+                )
+                # least recently used entries are evicted, pinned ones are kept
+                conn.execute(
+                    'DELETE FROM entries WHERE incident_id IN (SELECT incident_id FROM entries WHERE pinned = 0 ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+            self.cache_put(incident_id, entry)
+        return entry
+
+
+    def discard(self, incident_id: str) -> None:
+        with self.lock:
+            self.cache.pop(incident_id, None)
+            with self.connect() as conn:
+                conn.execute('DELETE FROM entries WHERE incident_id = ?', (incident_id,))
@@ -1,11 +1,13 @@
-import os
 import time
-import glob
 import logging
 import json
 from typing import Optional, Dict, Any, List
 
 from src.kuma_api import KUMA_API
+from src.spool import get_spool, get_spool_watcher
+from src.dispatcher import UpdateDispatcher
+from src import metrics
+from src.incident_index import IncidentIndex
 
 class KUMA():
 
@@ -13,10 +15,16 @@ class KUMA():
     priority_mapping = {
         'LOW': 1,
         'MEDIUM': 2,
+        'NORMAL': 2,
         'HIGH': 3,
         '': 4
     }
 
+    resolution_mapping = {
+        'True positive': 'approved',
+        'False positive': 'not approved'
+    }
+
     def __init__(self, config):
         api_url = config['kuma'].get('api_url')
         api_token = config['kuma'].get('api_token')
@@ -24,54 +32,122 @@ class KUMA():
         self.tenant_id = config['kuma'].get('tenant_id')
         self.period = config['kuma'].get('period', 60)
         self.data_dir = config.get('data_dir', 'data')
-        self.api = KUMA_API(api_url, api_token, ssl_cert)
+        spool_config = config.get('spool') or {}
+        self.batch_size = spool_config.get('batch_size')
+        self.coalesce = spool_config.get('coalesce', True)
+        self.settle_delay = spool_config.get('settle_delay', 2)
+        self.spool = get_spool(config)
+        self.watcher = get_spool_watcher(config)
+        self.workers = config['kuma'].get('workers', 4)
+        # the index is the only record of the KUMA incident of an MDR incident, it's evicted only after the close
+        self.index = IncidentIndex(f'{self.data_dir}/kuma_index.db', max_entries = config['kuma'].get('index_size', 10000), pin = lambda entry: not entry.get('closed'))
+        self.api = KUMA_API(
+            api_url,
+            api_token,
+            ssl_cert,
+            timeout = config['kuma'].get('timeout', 30),
+            rate_limit = config['kuma'].get('rate_limit', 10),
+            burst = config['kuma'].get('burst', 20),
+            retries = config['kuma'].get('retries', 3),
+            backoff = config['kuma'].get('backoff', 1),
+            workers = self.workers
+        )
+        # incidents whose creation has failed during the current cycle
+        self.failed_creates = set()
 
 
     def scan_folder(self):
-        files = glob.glob(f'{self.data_dir}/*.json')
-        self.logger.info(f'Found {len(files)} file(s) to process')
-        return files
+        updates = self.spool.claim(self.batch_size)
+        self.logger.info(f'Found {len(updates)} update(s) to process')
+        return updates
 
     
     def process_updates(self):
-        files = self.scan_folder()
-        for update_file in files:
-            with open(update_file, 'r') as f:
-                data = json.load(f)
-            if 'new_incident' in update_file:
-                if self.create_incident(data):
-                    self.set_update_as_processed(update_file)
-            if '-update_incident' in update_file:
-                if self.update_case(data):
-                    self.set_update_as_processed(update_file)
-            if '-new_attachment' in update_file:
-                if self.add_attachment(data):
-                    self.set_update_as_processed(update_file)
-            if '-new_comment' in update_file:
-                if self.add_comment(data):
-                    self.set_update_as_processed(update_file)
+        handlers = {
+            'new_incident': self.create_incident,
+            'update_incident': self.update_incident,
+            'new_attachment': self.add_attachment,
+            'new_comment': self.add_comment,
+            'new_response': self.add_response,
+        }
+        updates = self.scan_folder()
+        self.create_incidents(updates)
+        # incidents are delivered in parallel, updates of one incident in order
+        dispatcher = UpdateDispatcher(self.spool, handlers, workers = self.workers, coalesce = self.coalesce, settle_delay = self.settle_delay, sink = 'kuma')
+        stats = dispatcher.dispatch(updates)
+        self.logger.info(
+            f"{stats['processed']} update(s) processed, {stats['failed']} failed, {stats['skipped']} skipped, "
+            f"{stats['coalesced']} coalesced, {stats['held']} held"
+        )
+        return stats
 
 
-    def create_incident(self, data):
-        
-        incident_data = {
+    def build_incident_data(self, data):
+        return {
             "name": data['summary'],
             "tenantID": self.tenant_id,
             "description": f'https://mdr.kaspersky.com/incidents/{data["incident_id"]}\n\nDescription: {data["description"]}\n\nStatus description: {data["status_description"]}',
             "type": {},
-            "priority": self.priority_mapping[data['priority']],
+            "priority": self.priority_mapping.get(data.get('priority'), 4),
             "assigneeId": "",
             "alerts": [],
             "assets": [],
             "accounts": [],
             "availableTenants": []
         }
+
+
+    def create_incidents(self, updates):
+        # new incidents of the batch are sent together before the updates are dispatched
+        self.failed_creates = set()
+        new_incidents = {}
+        for update in updates:
+            incident_id = update['data'].get('incident_id')
+            if update['update_type'] != 'new_incident' or incident_id in new_incidents or incident_id in self.failed_creates:
+                continue
+            if self.get_kuma_id(incident_id) is not None:
+                continue
+            try:
+                new_incidents[incident_id] = (update['data'], self.build_incident_data(update['data']))
+            except Exception as e:
+                # the update is released by create_incident, the rest of the batch is created
+                self.logger.exception(f'KUMA incident of {incident_id} can not be built')
+                self.failed_creates.add(incident_id)
+        if not new_incidents:
+            return
+        results = self.api.create_incidents([incident_data for data, incident_data in new_incidents.values()])
+        created = 0
+        for (incident_id, (data, incident_data)), response in zip(new_incidents.items(), results):
+            if isinstance(response, Exception):
+                self.logger.error(f'Incident create error: {str(response)}')
+                self.failed_creates.add(incident_id)
+            elif response.status_code != 200:
+                self.logger.error(f"KUMA incident creation has been failed with status code {response.status_code}: {response.text}")
+                self.failed_creates.add(incident_id)
+            else:
+                self.index.set(incident_id, kuma_id = response.json()['id'], status = data.get('status'))
+                self.logger.info(f"KUMA incident has been created successfully: {response.json()['id']}: {response.json()['name']}")
+                created += 1
+        self.logger.info(f'{created} of {len(new_incidents)} new incident(s) have been created in KUMA')
+
+
+    def create_incident(self, data):
+        incident_id = data['incident_id']
+        entry = self.index.get(incident_id)
+        if entry and entry.get('kuma_id'):
+            # created by create_incidents or sent again by MDR sync, e.g. after .last_check is reset
+            self.logger.debug(f"KUMA incident of {incident_id} already exists: {entry['kuma_id']}")
+            return True
+        if incident_id in self.failed_creates:
+            # already retried by the API client during this cycle
+            return False
         
         try:
-            response = self.api.create_incident(incident_data)
+            response = self.api.create_incident(self.build_incident_data(data))
             if response.status_code != 200:
                 self.logger.error(f"KUMA incident creation has been failed with status code {response.status_code}: {response.text}")
                 return False
+            self.index.set(incident_id, kuma_id = response.json()['id'], status = data.get('status'))
             self.logger.info(f"KUMA incident has been created successfully: {response.json()['id']}: {response.json()['name']}")
             return True
         except Exception as e:
@@ -79,16 +155,96 @@ class KUMA():
         return False
 
 
-    def set_update_as_processed(self, filename):
-        os.rename(filename, f'{filename}.processed')
+    def get_kuma_id(self, incident_id):
+        entry = self.index.get(incident_id)
+        if entry and entry.get('kuma_id'):
+            return entry['kuma_id']
+        return None
+
+
+    def add_kuma_comment(self, incident_id, comment):
+        kuma_id = self.get_kuma_id(incident_id)
+        if kuma_id is None:
+            # the incident has been created before the map or by someone else, there is nothing to update
+            self.logger.warning(f'KUMA incident of {incident_id} is unknown, the update is skipped')
+            return True
+        try:
+            response = self.api.comment_incident(kuma_id, comment)
+            if response.status_code != 200:
+                self.logger.error(f"KUMA incident comment has been failed with status code {response.status_code}: {response.text}")
+                return False
+            return True
+        except Exception as e:
+            self.logger.exception(f'Incident comment error: {str(e)}')
+        return False
+
+
+    def update_incident(self, data):
+        incident_id = data['incident_id']
+        entry = self.index.get(incident_id) or {}
+        kuma_id = entry.get('kuma_id')
+        if kuma_id is None:
+            self.logger.warning(f'KUMA incident of {incident_id} is unknown, the update is skipped')
+            return True
+        # KUMA incidents can't be edited through the API, the new state is added as a comment
+        if data.get('status') != entry.get('status'):
+            comment = f'MDR incident status: {data.get("status")}\n\nStatus description: {data.get("status_description")}'
+            if not self.add_kuma_comment(incident_id, comment):
+                return False
+            self.index.set(incident_id, status = data.get('status'))
+        if data.get('status') == 'Closed' and not entry.get('closed'):
+            try:
+                response = self.api.close_incident(kuma_id, self.resolution_mapping.get(data.get('resolution'), 'not approved'))
+                if response.status_code != 200:
+                    self.logger.error(f"KUMA incident closing has been failed with status code {response.status_code}: {response.text}")
+                    return False
+                self.index.set(incident_id, closed = True)
+                self.logger.info(f'KUMA incident has been closed: {kuma_id}')
+            except Exception as e:
+                self.logger.exception(f'Incident close error: {str(e)}')
+                return False
+        return True
+
+
+    def add_comment(self, data):
+        comment = data['comments'][0]
+        return self.add_kuma_comment(data['incident_id'], f'{comment["author_name"]}:\n{comment["text"]}')
+
+
+    def add_attachment(self, data):
+        # files aren't uploaded to KUMA, the comment refers to the attachment in MDR
+        attachment = data['attachments'][0]
+        return self.add_kuma_comment(
+            data['incident_id'],
+            f'{attachment["author_name"]} attached {attachment["full_name"]}: {attachment.get("caption", "")}\n{attachment.get("link", "")}'
+        )
+
+
+    def add_response(self, data):
+        response_data = data['responses'][0]
+        return self.add_kuma_comment(
+            data['incident_id'],
+            f'MDR response {response_data["type"]} ({response_data["response_id"]}):\n{json.dumps(response_data.get("parameters"), indent = 2)}\n\n{response_data.get("description", "")}'
+        )
 
 
     def run(self, logging_queue, logging_configurer):
         logging_configurer(logging_queue)
         self.logger = logging.getLogger(__name__)
         self.logger.info('started')
+        self.watcher.start()
+        metrics.set_ready()
         while True:
             self.logger.info('starting to process new updates..')
-            self.process_updates()
+            try:
+                stats = self.process_updates()
+            except Exception as e:
+                # claimed updates which haven't been acked are claimed again during the next cycle
+                self.logger.exception('Error while processing updates')
+                stats = {'held': 0}
             self.logger.info('MDR updates are processed')
-            time.sleep(self.period)
\ No newline at end of file
+            # wakes up as soon as MDR sync pushes an update, period is the longest wait
+            # held updates are delivered when their incident settles
+            timeout = self.settle_delay if stats['held'] else self.period
+            metrics.heartbeat(timeout)
+            self.watcher.wait(timeout)
\ No newline at end of file
@@ -1,19 +1,25 @@
-import glob
 import os
 import yaml
 import json
 import time
+import logging
 import uuid
-from typing import Optional, Dict, Any, List, Union
+import contextlib
+import concurrent.futures
+from typing import Optional, Dict, Any, List, Union, Callable, Iterator
 
 from thehive4py.api import TheHiveApi
-from thehive4py.query import And, Eq
+from thehive4py.query import And, Or, Eq, In, ParentId
 from thehive4py.models import Alert, AlertArtifact, CustomFieldHelper
 from thehive4py.models import Case, CaseObservable, CaseTask, CaseObservable, CaseTaskLog
-from thehive4py.exceptions import AlertException, CaseException
+from thehive4py.exceptions import TheHiveException, AlertException, CaseException
 
 from src.mdr_api import MDRConsole
-from src.logger import MDRLogger
+from src.blob_store import get_blob_store
+from src.spool import get_spool, get_spool_watcher
+from src.dispatcher import UpdateDispatcher
+from src import metrics
+from src.incident_index import IncidentIndex
 
 class TheHive():
 
@@ -31,62 +37,163 @@ class TheHive():
     }
 
     def __init__(self, config: Dict[str, Any]) -> None:
-        logging_config = config.get('logging')
-        self.logger = MDRLogger(config = logging_config, name = self.__class__.__name__).getLogger()
         api_url = config['thehive'].get('api_url')
         api_key = config['thehive'].get('api_key')
         ssl_cert = config['thehive'].get('ssl_cert')
         self.period = config['thehive'].get('period', 60)
         self.data_dir = config.get('data_dir', 'data')
+        self.store = get_blob_store(config)
+        spool_config = config.get('spool') or {}
+        self.batch_size = spool_config.get('batch_size')
+        self.coalesce = spool_config.get('coalesce', True)
+        self.settle_delay = spool_config.get('settle_delay', 2)
+        self.spool = get_spool(config)
+        self.watcher = get_spool_watcher(config)
+        self.workers = config['thehive'].get('workers', 4)
+        self.index = IncidentIndex(f'{self.data_dir}/thehive_index.db', max_entries = config['thehive'].get('index_size', 10000))
+        self.lookup_batch_size = config['thehive'].get('lookup_batch_size', 100)
+        self.observable_workers = config['thehive'].get('observable_workers', 8)
+        self.observable_retries = config['thehive'].get('observable_retries', 2)
+        self.observable_max_cycles = config['thehive'].get('observable_max_cycles', 5)
         self.api = TheHiveApi(api_url, api_key)
-        self.logger.info('initialized')
 
 
-    def scan_folder(self):
-        files = glob.glob(f'{self.data_dir}/*.json')
-        self.logger.info(f'Found {len(files)} file(s) to process')
-        return files
+    def scan_folder(self) -> List[Dict[str, Any]]:
+        updates = self.spool.claim(self.batch_size)
+        self.logger.info(f'Found {len(updates)} update(s) to process')
+        return updates
 
     
     def process_updates(self) -> None:
-        files = self.scan_folder()
-        for update_file in files:
-            with open(update_file, 'r') as f:
-                data = json.load(f)
-            if 'new_incident' in update_file:
-                if self.create_case(data):
-                    self.set_update_as_processed(update_file)
-            if 'update_incident' in update_file:
-                if self.update_case(data):
-                    self.set_update_as_processed(update_file)
-            if 'new_attachment' in update_file:
-                if self.add_attachment(data):
-                    self.set_update_as_processed(update_file)
-            if 'new_comment' in update_file:
-                if self.add_comment(data):
-                    self.set_update_as_processed(update_file)
-            if 'new_response' in update_file:
-                if self.create_response_task(data):
-                    self.set_update_as_processed(update_file)        
+        handlers = {
+            'new_incident': self.create_case,
+            'update_incident': self.update_case,
+            'new_attachment': self.add_attachment,
+            'new_comment': self.add_comment,
+            'new_response': self.create_response_task,
+        }
+        updates = self.scan_folder()
+        self.resolve_cases(updates)
+        # incidents are delivered in parallel, updates of one incident in order
+        dispatcher = UpdateDispatcher(self.spool, handlers, workers = self.workers, coalesce = self.coalesce, settle_delay = self.settle_delay, sink = 'thehive')
+        stats = dispatcher.dispatch(updates)
+        self.logger.info(
+            f"{stats['processed']} update(s) processed, {stats['failed']} failed, {stats['skipped']} skipped, "
+            f"{stats['coalesced']} coalesced, {stats['held']} held"
+        )
+        return stats
 
-    def create_response_task(self, data: Dict[str, Any]) -> bool:
-        incident_id = data['incident_id']
-        # Find the case
+    def resolve_cases(self, updates: List[Dict[str, Any]]) -> None:
+        """
+        Looks up cases and response tasks of all incidents in the batch with a few
+        _in queries, instead of one search per update. The found ids are put into
+        the index, incidents which aren't resolved here are looked up one by one later.
+        """
+        incident_ids = []
+        need_task = set()
+        for update in updates:
+            incident_id = update['data'].get('incident_id')
+            if not incident_id or update['update_type'] == 'new_incident':
+                continue
+            entry = self.index.get(incident_id) or {}
+            if update['update_type'] in ('new_attachment', 'new_comment') and not entry.get('task_id'):
+                need_task.add(incident_id)
+            if not entry.get('case_id') and incident_id not in incident_ids:
+                incident_ids.append(incident_id)
+        try:
+            for i in range(0, len(incident_ids), self.lookup_batch_size):
+                chunk = incident_ids[i:i + self.lookup_batch_size]
+                response = self.api.find_cases(query = In('customFields.mdr-incident-id.string', chunk), range = 'all')
+                if response.status_code != 200:
+                    self.logger.error(f'find_cases has been failed with status code {response.status_code} - {response.text}')
+                    return
+                cases = {}
+                for case in response.json():
+                    incident_id = ((case.get('customFields') or {}).get('mdr-incident-id') or {}).get('string')
+                    cases.setdefault(incident_id, []).append(case['id'])
+                for incident_id, case_ids in cases.items():
+                    # ambiguous incidents are left to find_case, it reports them
+                    if incident_id in chunk and len(case_ids) == 1:
+                        self.index.set(incident_id, case_id = case_ids[0])
+            task_cases = {}
+            for incident_id in need_task:
+                entry = self.index.get(incident_id) or {}
+                if entry.get('case_id') and not entry.get('task_id'):
+                    task_cases[entry['case_id']] = incident_id
+            case_id_list = list(task_cases)
+            for i in range(0, len(case_id_list), self.lookup_batch_size):
+                chunk = case_id_list[i:i + self.lookup_batch_size]
+                query = And(
+                    Eq('title', 'MDR Response'),
+                    Or(*[ParentId('case', case_id) for case_id in chunk])
+                )
+                response = self.api.find_tasks(query = query, range = 'all')
+                if response.status_code != 200:
+                    self.logger.error(f'find_tasks has been failed with status code {response.status_code} - {response.text}')
+                    return
+                for task in response.json():
+                    incident_id = task_cases.get(task.get('_parent'))
+                    if incident_id:
+                        self.index.set(incident_id, task_id = task['id'])
+        except TheHiveException as e:
+            self.logger.exception('Case lookup error')
+
+    def find_case(self, incident_id: str) -> Optional[str]:
+        # TheHive is searched only if the index doesn't know the case yet
+        entry = self.index.get(incident_id)
+        if entry and entry.get('case_id'):
+            return entry['case_id']
         query = And(
             Eq('customFields.mdr-incident-id.string', incident_id)
         )
         response = self.api.find_cases(query = query, sort = ['-createdAt'], range = 'all')
         if response.status_code != 200:
             self.logger.error(f'find_cases has been failed with status code {response.status_code} - {response.text}')
-            return False 
+            return None
         if len(response.json()) > 1:
             self.logger.error(f'found more than 1 cases by filter: {incident_id}: {response.text}')
-            return False
+            return None
         if len(response.json()) == 0:
             self.logger.error(f'Not found any cases by filter: {incident_id}: {response.text}')
-            return False
-        case = response.json()[0]
-        
+            return None
+        case_id = response.json()[0]['id']
+        self.index.set(incident_id, case_id = case_id)
+        return case_id
+
+    def find_response_task(self, incident_id: str, case_id: str) -> Optional[str]:
+        entry = self.index.get(incident_id) or {}
+        if entry.get('task_id'):
+            return entry['task_id']
+        response = self.api.get_case_tasks(case_id)
+        if response.status_code != 200:
+            self.logger.error(f'get_case_tasks has been failed with status code {response.status_code} - {response.text}')
+            return None
+        tasks = response.json()
+        if len(tasks) == 0:
+            return None
+        task = next((task for task in tasks if task['title'] == 'MDR Response'), tasks[-1])
+        self.index.set(incident_id, task_id = task['id'])
+        return task['id']
+
+    def call_with_case(self, incident_id: str, call: Callable[[str, Optional[str]], Any], with_task: bool = False) -> Any:
+        # call(case_id, task_id) is repeated once with fresh ids if the indexed ones are stale
+        for attempt in range(2):
+            case_id = self.find_case(incident_id)
+            if case_id is None:
+                return None
+            task_id = None
+            if with_task:
+                task_id = self.find_response_task(incident_id, case_id)
+                if task_id is None:
+                    return None
+            response = call(case_id, task_id)
+            if response.status_code != 404 or attempt:
+                return response
+            self.logger.warning(f'case {case_id} of incident {incident_id} is not found, looking it up again')
+            self.index.discard(incident_id)
+
+    def create_response_task(self, data: Dict[str, Any]) -> bool:
+        incident_id = data['incident_id']
         # Build the task
         response_data = data['responses'][0]
         response_type = response_data['type']
@@ -104,7 +211,9 @@ class TheHive():
 
         # Create Task
         try:
-            response = self.api.create_case_task(case['id'], case_tasks)
+            response = self.call_with_case(incident_id, lambda case_id, task_id: self.api.create_case_task(case_id, case_tasks))
+            if response is None:
+                return False
             #print(response.status_code, json.dumps(response.json(), indent=2, sort_keys=True))
             if response.status_code != 201:
                 self.logger.error(f'task creating has been failed with status code {response.status_code} - {response.text}')
@@ -112,6 +221,41 @@ class TheHive():
             return True
         except CaseException as e:
             self.logger.exception('Task create error')
+        return False
+
+    def create_observables(self, case_id: str, observables: List[CaseObservable]) -> List[CaseObservable]:
+        """
+        Observables are sent concurrently by observable_workers threads, one request each:
+        every host observable has its own message (host_id), so they can't share a
+        multi-value request. Failed observables are retried observable_retries times,
+        the ones which still fail are returned. Observables rejected by TheHive (4xx)
+        aren't retried, they would be rejected again.
+        """
+        failed = observables
+        for attempt in range(self.observable_retries + 1):
+            if not failed:
+                break
+            with concurrent.futures.ThreadPoolExecutor(max_workers = self.observable_workers) as executor:
+                results = list(executor.map(lambda observable: self.send_observable(case_id, observable), failed))
+            failed = [observable for observable, done in zip(failed, results) if not done]
+            if failed:
+                self.logger.warning(f'{len(failed)} observable(s) of case {case_id} have not been created, attempt {attempt + 1}')
+        return failed
+
+    def send_observable(self, case_id: str, observable: CaseObservable) -> bool:
+        # False if the observable should be sent again
+        try:
+            response = self.api.create_case_observable(case_id, observable)
+        except TheHiveException as e:
+            self.logger.exception('Observable create error')
+            return False
+        if response.status_code == 201:
+            return True
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            self.logger.error(f'observable of case {case_id} has been rejected with status code {response.status_code} - {response.text}')
+            return True
+        self.logger.error(f'observable creating has been failed with status code {response.status_code} - {response.text}')
+        return False
 
     def create_case(self, data: Dict[str, Any]) -> bool:
         # Add Task
@@ -163,150 +307,111 @@ class TheHive():
                 ) 
             )
 
+        # a case created by an earlier attempt isn't created again, only its missing observables are sent.
+        # Pending observables are kept by host_id (the message), host names may repeat
+        entry = self.index.get(data['incident_id']) or {}
         try:
-            response = self.api.create_case(case)
-            #print(response.status_code, json.dumps(response.json(), indent=4, sort_keys=True))
-            if response.status_code != 201:
-                self.logger.error(f'case creating has been failed with status code {response.status_code} - {response.text}')
-                return False
-            for case_observable in case_observables:
-                response_obs = self.api.create_case_observable(response.json()['id'], case_observable)
+            case_id = entry.get('case_id')
+            if case_id:
+                pending = entry.get('pending_observables') or []
+                case_observables = [case_observable for case_observable in case_observables if case_observable.message in pending]
+            else:
+                response = self.api.create_case(case)
                 #print(response.status_code, json.dumps(response.json(), indent=4, sort_keys=True))
-                if response_obs.status_code != 201:
-                    self.logger.error(f'observable creating has been failed with status code {response_obs.status_code} - {response_obs.text}')
-            return True
+                if response.status_code != 201:
+                    self.logger.error(f'case creating has been failed with status code {response.status_code} - {response.text}')
+                    return False
+                case_id = response.json()['id']
+                self.index.set(data['incident_id'], case_id = case_id, pending_observables = [case_observable.message for case_observable in case_observables])
+            failed = self.create_observables(case_id, case_observables)
+            cycles = entry.get('observable_cycles', 0) + 1 if failed else 0
+            if failed and cycles >= self.observable_max_cycles:
+                # the rest of the incident isn't blocked any longer
+                self.logger.error(f'{len(failed)} observable(s) of case {case_id} have not been created in {cycles} cycles, giving up: {[case_observable.data for case_observable in failed]}')
+                failed = []
+            self.index.set(data['incident_id'], case_id = case_id, pending_observables = [case_observable.message for case_observable in failed], observable_cycles = cycles)
+            # the update is kept in the spool until every observable is created or given up
+            return not failed
         except CaseException as e:
             self.logger.exception('Case create error')
         return False
 
     def update_case(self, data: Dict[str, Any]) -> bool:
         incident_id = data['incident_id']
-        # Find the case
-        query = And(
-            Eq('customFields.mdr-incident-id.string', incident_id)
-        )
-        response = self.api.find_cases(query = query, sort = ['-createdAt'], range = 'all')
-        if response.status_code != 200:
-            self.logger.error(f'case finding has been failed with status code {response.status_code} - {response.text}')
-            return False 
-        if len(response.json()) > 1:
-            self.logger.error(f'found more than 1 cases by filter: {incident_id}: {response.text}')
-            return False
-        if len(response.json()) == 0:
-            self.logger.error(f'Not found any cases by filter: {incident_id}: {response.text}')
-            return False
-        case = response.json()[0]
         # Update Custom fields
         '''
         case['customFields']['mdr-incident-id']['string'] = 'qwe'
         '''
-        # Update fields
-        case = Case(json = case)
-        case.title = data['summary']
-        case.description = data['description']
+        # Update fields, only these fields are sent
         fields = ['title', 'description']
-
         if data['status'] == 'Closed':
-            case.resolutionStatus = self.resolution_mapping[data['resolution']]
-            case.status = 'Resolved'
-            case.summary = data['status_description']
             fields.extend(['resolutionStatus', 'status', 'summary'])
 
+        def update(case_id: str, task_id: Optional[str]) -> Any:
+            case = Case(json = {'id': case_id})
+            case.title = data['summary']
+            case.description = data['description']
+            if data['status'] == 'Closed':
+                case.resolutionStatus = self.resolution_mapping[data['resolution']]
+                case.status = 'Resolved'
+                case.summary = data['status_description']
+            return self.api.update_case(case, fields)
+
         try:
-            response = self.api.update_case(case, fields)
+            response = self.call_with_case(incident_id, update)
+            if response is None:
+                return False
             #print(response.status_code, json.dumps(response.json(), indent=4, sort_keys=True))
             if response.status_code == 200:
                 return True
+            self.logger.error(f'case updating has been failed with status code {response.status_code} - {response.text}')
         except CaseException as e:
             self.logger.exception('Case update error')
-        self.logger.error(f'case updating has been failed with status code {response.status_code} - {response.text}')
         return False
 
-    def add_attachment(self, data: Dict[str, Any]) -> None:
-        incident_id = data['incident_id']
-        # Find the case
-        query = And(
-            Eq('customFields.mdr-incident-id.string', incident_id)
-        )
-        response = self.api.find_cases(query = query, sort = ['-createdAt'], range = 'all')
-        if response.status_code != 200:
-            self.logger.error(f'find_cases has been failed with status code {response.status_code} - {response.text}')
-            return False 
-        if len(response.json()) > 1:
-            self.logger.error(f'found more than 1 cases by filter: {incident_id}: {response.text}')
-            return False
-        if len(response.json()) == 0:
-            self.logger.error(f'Not found any cases by filter: {incident_id}: {response.text}')
-            return False
-        case = response.json()[0]
-        # Find the task
-        response = self.api.get_case_tasks(case['id'])
-        if response.status_code != 200:
-            self.logger.error(f'get_case_tasks has been failed with status code {response.status_code} - {response.text}')
-            return False 
-        if len(response.json()) == 0:
-            return False
-        for task in response.json():
-            if task['title'] == 'MDR Response':
-                break
-        #print(task)
-        # Build case task log
+    @contextlib.contextmanager
+    def build_attachment_log(self, data: Dict[str, Any]) -> Iterator[CaseTaskLog]:
+        # the stored file is open while the log is being sent, CaseTaskLog takes a (file object, filename) tuple (thehive4py 1.8)
         caption = data['attachments'][0]['caption']
         link = data['attachments'][0]['link']
         author_name = data['attachments'][0]['author_name']
         filename = data['attachments'][0]['full_name']
         attachment_id = data['attachments'][0]['attachment_id']
-        filepath = f"{self.data_dir}/files/{attachment_id}_{filename}"
-        if os.path.exists(filepath):
-            case_task_log = CaseTaskLog(
-                message = f'{author_name}\n> {caption}',
-                file = filepath
-            )
-        else:
-            case_task_log = CaseTaskLog(
-                message = f'{author_name}\n> {caption}  \n  \n[{filename}]({link})'
-            )
+        blob = self.store.resolve(attachment_id)
+        if blob:
+            blob_path, filename = blob
+            with open(blob_path, 'rb') as f:
+                yield CaseTaskLog(
+                    message = f'{author_name}\n> {caption}',
+                    file = (f, filename)
+                )
+            return
+        yield CaseTaskLog(
+            message = f'{author_name}\n> {caption}  \n  \n[{filename}]({link})'
+        )
+
+    def add_attachment(self, data: Dict[str, Any]) -> None:
+        incident_id = data['incident_id']
+        # Create case task log, the log is built for every attempt since the file is read by the request
+
+        def create_log(case_id: str, task_id: Optional[str]) -> Any:
+            with self.build_attachment_log(data) as case_task_log:
+                return self.api.create_task_log(task_id, case_task_log)
 
-        # Create case task log
-        #response = self.api.create_task_log(task['id'], case_task_log)
         try:
-            response = self.api.create_task_log(task['id'], case_task_log)
+            response = self.call_with_case(incident_id, create_log, with_task = True)
+            if response is None:
+                return False
             #print(response.status_code, json.dumps(response.json(), indent=4, sort_keys=True))
             if response.status_code == 201:
                 return True
+            self.logger.error(f'Case task log creation has been failed with status code {response.status_code} - {response.text}')
         except CaseException as e:
             self.logger.exception('Case task log creation error')
-        self.logger.error(f'Case task log creation has been failed with status code {response.status_code} - {response.text}')
         return False
 
     def add_comment(self, data: Dict[str, Any]) -> None:
         incident_id = data['incident_id']
-        # Find the case
-        query = And(
-            Eq('customFields.mdr-incident-id.string', incident_id)
-        )
-        response = self.api.find_cases(query = query, sort = ['-createdAt'], range = 'all')
-        if response.status_code != 200:
-            self.logger.error(f'find_cases has been failed with status code {response.status_code} - {response.text}')
-            return False 
-        if len(response.json()) > 1:
-            self.logger.error(f'found more than 1 cases by filter: {incident_id}: {response.text}')
-            return False
-        if len(response.json()) == 0:
-            self.logger.error(f'Not found any cases by filter: {incident_id}: {response.text}')
-            return False
-        case = response.json()[0]
-        # Find the task
-        response = self.api.get_case_tasks(case['id'])
-        if response.status_code != 200:
-            self.logger.error(f'get_case_tasks has been failed with status code {response.status_code} - {response.text}')
-            return False 
-        if len(response.json()) == 0:
-            return False
-        for task in response.json():
-            if task['title'] == 'MDR Response':
-                break
-        #print(task)
         # Build case task log
         text = data['comments'][0]['text']
         author_name = data['comments'][0]['author_name']
@@ -315,24 +420,35 @@ class TheHive():
         )
         # Create case task log
         try:
-            response = self.api.create_task_log(task['id'], case_task_log)
+            response = self.call_with_case(incident_id, lambda case_id, task_id: self.api.create_task_log(task_id, case_task_log), with_task = True)
+            if response is None:
+                return False
             #print(response.status_code, json.dumps(response.json(), indent=4, sort_keys=True))
             if response.status_code == 201:
                 return True
+            self.logger.error(f'Case task log creation has been failed with status code {response.status_code} - {response.text}')
         except CaseException as e:
             self.logger.exception('Case task log creation error')
-        self.logger.error(f'Case task log creation has been failed with status code {response.status_code} - {response.text}')
         return False
 
 
-    def set_update_as_processed(self, filename: str) -> None:
-        os.rename(filename, f'{filename}.processed')
-
-
-    def run(self) -> None:
+    def run(self, logging_queue, logging_configurer) -> None:
+        logging_configurer(logging_queue)
+        self.logger = logging.getLogger(__name__)
         self.logger.info('started')
+        self.watcher.start()
+        metrics.set_ready()
         while True:
             self.logger.info('starting to process new updates..')
-            self.process_updates()
+            try:
+                stats = self.process_updates()
+            except Exception as e:
+                # claimed updates which haven't been acked are claimed again during the next cycle
+                self.logger.exception('Error while processing updates')
+                stats = {'held': 0}
             self.logger.info('processing updates finished')
-            time.sleep(self.period)
\ No newline at end of file
+            # wakes up as soon as MDR sync pushes an update, period is the longest wait
+            # held updates are delivered when their incident settles
+            timeout = self.settle_delay if stats['held'] else self.period
+            metrics.heartbeat(timeout)
+            self.watcher.wait(timeout)
\ No newline at end of file
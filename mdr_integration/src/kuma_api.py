@@ -1,17 +1,60 @@
 import requests
 import json
+import time
+import random
+import threading
 import urllib.parse
 import urllib3
 import logging
+import concurrent.futures
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
+class TokenBucket:
+    """
+    Allows rate requests per second on average and bursts of up to burst requests.
+    Shared by the threads of a sink.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
 class KUMA_API:
 
     INCIDENT_CREATE_PATH = "/incidents/create"
+    INCIDENT_COMMENT_PATH = "/incidents/comment"
+    INCIDENT_CLOSE_PATH = "/incidents/close"
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    # codes of requests KUMA hasn't handled, non-idempotent requests are retried only on these
+    REJECTED_STATUS_CODES = (429, 503)
     
-    def __init__(self, url, api_token, ssl_cert):
+    def __init__(self, url, api_token, ssl_cert, timeout = 30, rate_limit = 10, burst = 20, retries = 3, backoff = 1, max_backoff = 30, workers = 4):
+        """
+        rate_limit - requests per second on average, burst - requests sent at once
+        retries - attempts after the first one on 429, 5xx and connection errors, delays grow
+        exponentially from backoff up to max_backoff seconds with full jitter, Retry-After is respected.
+        incidents/create and incidents/comment aren't idempotent, they are retried only if KUMA
+        hasn't got or rejected the request
+        workers - concurrent requests of create_incidents
+        """
         self.url = url + '/api/v2.1'
         headers = {
             'Authorization': f'Bearer {api_token}'
@@ -20,6 +63,46 @@ class KUMA_API:
         self.session = requests.Session()
         self.session.headers.update(headers)
         self.session.verify = ssl_cert
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.workers = workers
+        self.bucket = TokenBucket(rate_limit, burst)
+        self.logger = logging.getLogger(__name__)
+
+    def get_delay(self, attempt, response = None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def is_connect_error(self, e):
+        # the connection hasn't been established, so the request hasn't reached KUMA
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def post(self, path, json_data, idempotent = True):
+        url = self.url + path
+        retry_status_codes = self.RETRY_STATUS_CODES if idempotent else self.REJECTED_STATUS_CODES
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                result = self.session.post(url = url, json = json_data, timeout = self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # a read timeout may come after KUMA has created the incident or the comment, the update is released instead
+                if attempt == self.retries or not (idempotent or self.is_connect_error(e)):
+                    raise
+                delay = self.get_delay(attempt)
+                self.logger.warning(f'Request to {path} has failed: {e}, retrying in {delay:.1f}s')
+            else:
+                if result.status_code not in retry_status_codes or attempt == self.retries:
+                    return result
+                delay = self.get_delay(attempt, result)
+                self.logger.warning(f'Request to {path}, HTTP code {result.status_code}, retrying in {delay:.1f}s')
+            time.sleep(delay)
     
     def create_incident(self, incident_data):
         """
@@ -61,6 +144,36 @@ class KUMA_API:
             ]
         }
         """
-        url = self.url + self.INCIDENT_CREATE_PATH
-        result = self.session.post(url = url, json = incident_data)
-        return result
\ No newline at end of file
+        return self.post(self.INCIDENT_CREATE_PATH, incident_data, idempotent = False)
+
+    def create_incidents(self, incidents_data):
+        """
+        Creates many incidents within the rate limit, KUMA has no bulk endpoint,
+        so the requests are sent by the worker pool.
+        Returns a response or an exception per incident, in order.
+        """
+        def create(incident_data):
+            try:
+                return self.create_incident(incident_data)
+            except requests.exceptions.RequestException as e:
+                return e
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers) as executor:
+            return list(executor.map(create, incidents_data))
+
+
+    def comment_incident(self, incident_id, comment):
+        """
+        Example:
+        incident_id = "00000000-0000-0000-0000-000000000000"
+        comment = "comment text"
+        """
+        return self.post(self.INCIDENT_COMMENT_PATH, {"id": incident_id, "comment": comment}, idempotent = False)
+
+
+    def close_incident(self, incident_id, resolution):
+        """
+        Example:
+        incident_id = "00000000-0000-0000-0000-000000000000"
+        resolution = "approved"  # or "not approved"
+        """
+        return self.post(self.INCIDENT_CLOSE_PATH, {"id": incident_id, "resolution": resolution})
@@ -1,7 +1,127 @@
+import json
+import time
+import queue
 import logging
+import logging.handlers
 from logging.handlers import TimedRotatingFileHandler
 from typing import Optional, Dict, Any, List
 
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON document per line (NDJSON).
+    Example:
+    {"time": "2022-06-13T10:15:27.123", "level": "INFO", "logger": "src.mdr_sync", "process": 1234, "message": "started"}
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            'time': f'{self.formatTime(record, "%Y-%m-%dT%H:%M:%S")}.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            document['exception'] = record.exc_text
+        return json.dumps(document, ensure_ascii = False)
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Limits records of one call site (logger, file, line) below ERROR to limit per window
+    seconds. Above the limit one record of every sample_rate is passed, it tells how
+    many records have been suppressed.
+    """
+
+    def __init__(self, limit: int = 20, window: float = 60, sample_rate: int = 100) -> None:
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.sample_rate = sample_rate
+        self.sites = {}
+
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR or not self.limit:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        started, count, suppressed = self.sites.get(key, (now, 0, 0))
+        if now - started > self.window:
+            if len(self.sites) > 10000:
+                self.sites.clear()
+            started, count = now, 0
+        count += 1
+        if count <= self.limit or (self.sample_rate and count % self.sample_rate == 0):
+            if suppressed:
+                record.msg = f'{record.getMessage()} ({suppressed} similar records suppressed)'
+                record.args = None
+            self.sites[key] = (started, count, 0)
+            return True
+        self.sites[key] = (started, count, suppressed + 1)
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Never blocks the process: records are dropped when the log queue is full,
+    the number of dropped records is reported by the next passed record.
+    """
+
+    def __init__(self, queue: Any) -> None:
+        super().__init__(queue)
+        self.dropped = 0
+
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.dropped:
+            try:
+                self.queue.put_nowait(self.prepare(logging.makeLogRecord({
+                    'name': __name__,
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': f'{self.dropped} log records have been dropped, the log queue is full'
+                })))
+                self.dropped = 0
+            except queue.Full:
+                pass
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchedFileHandler(TimedRotatingFileHandler):
+    # the stream is flushed by MDRLogger once per batch instead of after every record
+
+    def flush(self) -> None:
+        pass
+
+
+    def flush_batch(self) -> None:
+        super().flush()
+
+
+def configure_process(queue: Any, config: Dict[str, Any]) -> None:
+    """
+    Sends the records of the process to MDRLogger. Records below log_level
+    and repeated records aren't even put into the queue.
+    """
+    handler = DroppingQueueHandler(queue)
+    handler.setLevel(MDRLogger.level[config.get('log_level', 'INFO').upper()])
+    handler.addFilter(RepeatFilter(
+        limit = config.get('repeat_limit', 20),
+        window = config.get('repeat_window', 60),
+        sample_rate = config.get('sample_rate', 100)
+    ))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+
+
 class MDRLogger():
 
     level = {
@@ -14,35 +134,56 @@ class MDRLogger():
 
     def __init__(self) -> Any:
         pass
-    
+
     def init(self, config, name):
         log_level = self.level[config['log_level'].upper()]
         log_dir = config['log_dir']
+        self.batch_size = config.get('batch_size', 500)
+        self.flush_interval = config.get('flush_interval', 1)
         self.logger = logging.getLogger(name)
         self.logger.setLevel(log_level)
-        file_handler = TimedRotatingFileHandler(
+        self.file_handler = BatchedFileHandler(
             filename = f'{log_dir}/app.log',
             when = 'D',
             interval = 1,
             backupCount = 7
         )
-        
-        file_handler.setLevel(log_level)
-        log_format = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
-        file_handler.setFormatter(log_format)
-        self.logger.addHandler(file_handler)
+
+        self.file_handler.setLevel(log_level)
+        if config.get('format', 'text') == 'json':
+            log_format = JSONFormatter()
+        else:
+            log_format = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+        self.file_handler.setFormatter(log_format)
+        self.logger.addHandler(self.file_handler)
 
     def run(self, queue, config):
         self.init(config, __name__)
         self.logger.info('MDR logger started')
+        last_flush = time.monotonic()
         while True:
             try:
-                record = queue.get()
-                if record is None:
-                    break
-                self.logger.handle(record)
+                # records are written in batches, the file is flushed once per batch or flush_interval
+                records = self.get_batch(queue, max(last_flush + self.flush_interval - time.monotonic(), 0.01))
+                for record in records:
+                    if record is None:
+                        self.file_handler.flush_batch()
+                        return
+                    self.logger.handle(record)
+                if len(records) >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval:
+                    self.file_handler.flush_batch()
+                    last_flush = time.monotonic()
             except Exception:
                 import sys, traceback
                 print('Whoops! Problem:', file=sys.stderr)
                 traceback.print_exc(file=sys.stderr)
 
+    def get_batch(self, log_queue, timeout):
+        records = []
+        try:
+            records.append(log_queue.get(timeout = timeout))
+            while len(records) < self.batch_size and records[-1] is not None:
+                records.append(log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        return records
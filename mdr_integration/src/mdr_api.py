@@ -1,7 +1,41 @@
 import requests
-from typing import Optional, Dict, Any, List
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, Any, List, Callable
 import os
 import json
+import time
+
+from src import metrics
+
+
+# Keep-alive sessions shared by all MDRConsole instances of a process. Reusing
+# the pooled connections also reuses their TLS sessions, so only the first
+# request to a host pays for the TCP and TLS handshakes.
+_sessions = {}
+
+
+def get_session(pool_connections: int = 10, pool_maxsize: int = 10, pool_block: bool = False, pool_hosts: Optional[Dict[str, int]] = None) -> requests.Session:
+    """
+    pool_connections - how many per-host pools are cached
+    pool_maxsize - how many keep-alive connections are kept per host
+    pool_block - wait for a free connection instead of opening an extra one
+    pool_hosts - per-host pool size overrides, e.g. {"mdr.kaspersky.com": 20}
+    """
+    pool_hosts = pool_hosts or {}
+    # sockets must not be shared with a forked child, so the key includes the pid
+    key = (os.getpid(), pool_connections, pool_maxsize, pool_block, tuple(sorted(pool_hosts.items())))
+    session = _sessions.get(key)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_connections, pool_maxsize = pool_maxsize, pool_block = pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        for host, maxsize in pool_hosts.items():
+            host_adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = maxsize, pool_block = pool_block)
+            session.mount(f'https://{host}', host_adapter)
+            session.mount(f'http://{host}', host_adapter)
+        _sessions[key] = session
+    return session
 
 
 class MDRConsole():
@@ -26,28 +60,74 @@ class MDRConsole():
     RESPONSES_UPDATE_PATH = "responses/update"
     SESSION_CONFIRM_PATH = "session/confirm"
 
-    def __init__(self, api_url: str, client_id: str, refresh_token: Optional[str] = None, access_token: Optional[str] = None, ssl_cert: Optional[str] = False) -> None:
+    def __init__(self, api_url: str, client_id: str, refresh_token: Optional[str] = None, access_token: Optional[str] = None, ssl_cert: Optional[str] = False, http: Optional[Dict[str, Any]] = None, token_provider: Optional[Callable[[Optional[str]], str]] = None) -> None:
+        """
+        token_provider(stale_token) returns a new access token when MDR rejects the current one with 401,
+        the request is repeated once with it. See src.token_broker.TokenClient.get
+        Example:
+        http = {
+            "timeout": 60,  # seconds
+            "pool_connections": 10,
+            "pool_maxsize": 10,
+            "pool_block": False,
+            "pool_hosts": {"mdr.kaspersky.com": 10}
+        }
+        """
         self.api_url = api_url
         self.client_id = client_id
         self.ssl_cert = ssl_cert
+        self.token_provider = token_provider
+        http = http or {}
+        self.timeout = http.get('timeout')
+        self.pool = {
+            'pool_connections': http.get('pool_connections', 10),
+            'pool_maxsize': http.get('pool_maxsize', 10),
+            'pool_block': http.get('pool_block', False),
+            'pool_hosts': http.get('pool_hosts'),
+        }
         if refresh_token:
             self.access_token, self.refresh_token = self.get_access_token(refresh_token)
         elif access_token:
             self.access_token = access_token
     
 
-    def post(self, *, path: str, json_data: Dict[str, Any], headers: Optional[Dict[str, str]] = None, download: Optional[bool] = False) -> Dict:
+    @property
+    def session(self) -> requests.Session:
+        return get_session(**self.pool)
+
+
+    def post(self, *, path: str, json_data: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None, download: Optional[bool] = False, files: Optional[Dict[str, Any]] = None, data: Optional[Dict[str, Any]] = None, stream: Optional[bool] = False) -> Dict:
         kwargs = {
             "url": f"{self.api_url}/{self.client_id}/{path}",
-            "json": json_data,
             "verify": self.ssl_cert,
+            "timeout": self.timeout,
         }
+        if json_data is not None:
+            kwargs["json"] = json_data
         if headers is not None:
             kwargs["headers"] = headers
+        if files is not None:
+            kwargs["files"] = files
+        if data is not None:
+            kwargs["data"] = data
+        if stream:
+            kwargs["stream"] = True
         #print(path)
-        resp = requests.post(**kwargs)
+        resp = self.send(path, kwargs)
         #print(kwargs)
-
+        if resp.status_code == 401 and self.token_provider and headers and 'Authorization' in headers:
+            # the token has expired or been revoked, the request is repeated once with a new one
+            resp.close()
+            self.access_token = self.token_provider(self.access_token)
+            kwargs["headers"] = dict(headers, **self.get_auth_header(self.access_token))
+            for value in (files or {}).values():
+                if isinstance(value, tuple) and hasattr(value[1], 'seek'):
+                    value[1].seek(0)
+            resp = self.send(path, kwargs)
+
+        if stream and resp.status_code in (200, 206):
+            # the caller reads the body and closes the response
+            return resp
         if resp.status_code == 200:
             if download:
                 return resp.content
@@ -56,6 +136,21 @@ class MDRConsole():
             raise Exception(f'Request to {path}, HTTP code {str(resp.status_code)} - {resp.text}')
 
 
+    def send(self, path: str, kwargs: Dict[str, Any]) -> requests.Response:
+        # latency and errors are measured per endpoint
+        started = time.monotonic()
+        try:
+            resp = self.session.post(**kwargs)
+        except requests.exceptions.RequestException as e:
+            metrics.inc('mdr_api_errors_total', path = path, code = 'connection')
+            raise
+        finally:
+            metrics.observe('mdr_api_request_seconds', time.monotonic() - started, path = path)
+        if resp.status_code not in (200, 206):
+            metrics.inc('mdr_api_errors_total', path = path, code = resp.status_code)
+        return resp
+
+
     def get_access_token(self, refresh_token: str) -> str:
         result = self.post(path = self.SESSION_CONFIRM_PATH, json_data = {"refresh_token": refresh_token})
         access_token = result["access_token"]
@@ -147,6 +242,19 @@ class MDRConsole():
         return result
 
 
+    def attachments_download_stream(self, attachment_id: str, offset: int = 0) -> requests.Response:
+        """
+        Streaming version of attachments_download, the body is read with iter_content().
+        The response has to be closed by the caller. If offset is set, the download is
+        resumed with a Range request; the status code is 206 if the server honours it.
+        """
+        headers = self.get_auth_header(self.access_token)
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        result = self.post(path = self.ATTACHMENTS_DOWNLOAD_PATH, json_data = {'attachment_id': attachment_id}, headers=headers, stream = True)
+        return result
+
+
     def get_attachments_list(self, incident_id: str, **kwargs) -> Dict[str, Any]:
         """
         Example:
@@ -174,26 +282,23 @@ class MDRConsole():
             
         }
         """
-        path = self.ATTACHMENTS_UPLOAD_PATH
         headers = self.get_auth_header(self.access_token)
-        resp = requests.post(
-            url = f"{self.api_url}/{self.client_id}/{path}",
-            headers = headers,
-            files = {
-                'file': (
-                    os.path.basename(kwargs['file']),
-                    open(kwargs['file'], 'rb'),
-                    'application/octet-stream'
-                )
-            },
-            data = {
-                'meta': json.dumps(kwargs['meta'])
-            }
-        )
-        if resp.status_code == 200:
-            return resp.json()
-        else:
-            raise Exception(f'Request to {path}, HTTP code {str(resp.status_code)} - {resp.text}')
+        with open(kwargs['file'], 'rb') as f:
+            result = self.post(
+                path = self.ATTACHMENTS_UPLOAD_PATH,
+                headers = headers,
+                files = {
+                    'file': (
+                        os.path.basename(kwargs['file']),
+                        f,
+                        'application/octet-stream'
+                    )
+                },
+                data = {
+                    'meta': json.dumps(kwargs['meta'])
+                }
+            )
+        return result
 
 
     def comments_create(self, incident_id: str, text: str, **kwargs) -> Dict[str, Any]:
@@ -0,0 +1,142 @@
+import ssl
+import os
+import json
+import time
+import asyncio
+from typing import Optional, Dict, Any, List, Callable
+
+import aiohttp
+
+from src import metrics
+from src.mdr_api import MDRConsole
+
+
+class AsyncMDRConsole(MDRConsole):
+    """
+    asyncio counterpart of MDRConsole. All endpoint methods of MDRConsole
+    (get_incidents_list, get_comments_list, attachments_download, responses_update, ...)
+    have the same arguments and results but have to be awaited. Requests of one
+    instance share a single aiohttp connection pool.
+
+    Example:
+    async with AsyncMDRConsole(api_url = api_url, client_id = client_id, access_token = access_token) as mdr:
+        comments = await asyncio.gather(*[mdr.get_comments_list(incident_id) for incident_id in incident_ids])
+    """
+
+    def __init__(self, api_url: str, client_id: str, refresh_token: Optional[str] = None, access_token: Optional[str] = None, ssl_cert: Optional[str] = False, http: Optional[Dict[str, Any]] = None, token_provider: Optional[Callable[[Optional[str]], str]] = None) -> None:
+        # the refresh token can be exchanged only inside the event loop, see open()
+        super().__init__(api_url = api_url, client_id = client_id, access_token = access_token, ssl_cert = ssl_cert, http = http, token_provider = token_provider)
+        self.refresh_token = refresh_token
+        self._session = None
+
+
+    async def __aenter__(self) -> 'AsyncMDRConsole':
+        await self.open()
+        return self
+
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+    async def open(self) -> None:
+        if self.refresh_token and not getattr(self, 'access_token', None):
+            self.access_token, self.refresh_token = await self.get_access_token(self.refresh_token)
+
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+    def get_ssl(self) -> Any:
+        if self.ssl_cert is False:
+            return False
+        if self.ssl_cert:
+            return ssl.create_default_context(cafile = self.ssl_cert)
+        return True
+
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit = self.pool['pool_connections'] * self.pool['pool_maxsize'],
+                limit_per_host = self.pool['pool_maxsize'],
+                ssl = self.get_ssl()
+            )
+            timeout = aiohttp.ClientTimeout(total = self.timeout)
+            self._session = aiohttp.ClientSession(connector = connector, timeout = timeout)
+        return self._session
+
+
+    async def post(self, *, path: str, json_data: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None, download: Optional[bool] = False, data: Optional[aiohttp.FormData] = None, stream: Optional[bool] = False) -> Dict:
+        kwargs = {
+            "url": f"{self.api_url}/{self.client_id}/{path}",
+        }
+        if json_data is not None:
+            kwargs["json"] = json_data
+        if headers is not None:
+            kwargs["headers"] = headers
+        if data is not None:
+            kwargs["data"] = data
+        resp = await self.send(path, kwargs)
+        if resp.status == 401 and self.token_provider and headers and 'Authorization' in headers and not isinstance(data, aiohttp.FormData):
+            # the token has expired or been revoked, the request is repeated once with a new one
+            resp.release()
+            self.access_token = await asyncio.get_running_loop().run_in_executor(None, self.token_provider, self.access_token)
+            kwargs["headers"] = dict(headers, **self.get_auth_header(self.access_token))
+            resp = await self.send(path, kwargs)
+        if stream and resp.status in (200, 206):
+            # the caller reads resp.content and releases the response
+            return resp
+        async with resp:
+            if resp.status == 200:
+                if download:
+                    return await resp.read()
+                return await resp.json(content_type = None)
+            else:
+                raise Exception(f'Request to {path}, HTTP code {str(resp.status)} - {await resp.text()}')
+
+
+    async def send(self, path: str, kwargs: Dict[str, Any]) -> aiohttp.ClientResponse:
+        started = time.monotonic()
+        try:
+            resp = await self.session.post(**kwargs)
+        except aiohttp.ClientError as e:
+            metrics.inc('mdr_api_errors_total', path = path, code = 'connection')
+            raise
+        finally:
+            metrics.observe('mdr_api_request_seconds', time.monotonic() - started, path = path)
+        if resp.status not in (200, 206):
+            metrics.inc('mdr_api_errors_total', path = path, code = resp.status)
+        return resp
+
+
+    async def get_access_token(self, refresh_token: str) -> str:
+        result = await self.post(path = self.SESSION_CONFIRM_PATH, json_data = {"refresh_token": refresh_token})
+        access_token = result["access_token"]
+        refresh_token = result["refresh_token"]
+        return access_token, refresh_token
+
+
+    async def attachments_upload(self, **kwargs) -> Dict[str, Any]:
+        """
+        Example:
+        kwargs = {
+            "file": "filepath",
+            "meta": {
+                "caption": "comment_string",
+                "incident_id": "2NJMGXkBNGNeZ5iut24S",  # required
+            }
+
+        }
+        """
+        headers = self.get_auth_header(self.access_token)
+        with open(kwargs['file'], 'rb') as f:
+            data = aiohttp.FormData()
+            data.add_field('file', f, filename = os.path.basename(kwargs['file']), content_type = 'application/octet-stream')
+            data.add_field('meta', json.dumps(kwargs['meta']))
+            result = await self.post(path = self.ATTACHMENTS_UPLOAD_PATH, headers = headers, data = data)
+        return result
@@ -1,3 +1,4 @@
+import os
 import yaml
 import json
 import time
@@ -6,28 +7,94 @@ import logging
 from typing import Optional, Dict, Any, List, Union
 
 from src.mdr_api import MDRConsole
+from src.token_broker import TokenClient
+from src.scheduler import AdaptiveScheduler
+from src import metrics
+from src.spool import get_spool
+from src.attachment_downloader import enqueue_download, get_queue_dir
+from src.blob_store import get_blob_store
 
 class MDRSync():
 
+    # entity types of incidents/history records
+    HISTORY_ENTITY_TYPES = ['incident', 'attachment', 'comment', 'response']
+    # incident fields without the child arrays of comments, attachments and responses
+    INCIDENT_FIELDS = [
+        'affected_hosts', 'affected_hosts_mappings', 'creation_time', 'description', 'detection_technologies',
+        'incident_id', 'mitre_tactics', 'mitre_techniques', 'priority', 'resolution', 'status',
+        'status_description', 'summary', 'tenant_name', 'update_time'
+    ]
+    # fields the sync itself relies on, they are added to every configured projection
+    REQUIRED_FIELDS = {
+        'incidents': ['creation_time', 'incident_id', 'priority', 'status', 'update_time'],
+        'attachments': ['attachment_id', 'author_name', 'creation_time', 'file_size', 'full_name'],
+        'comments': ['author_name', 'comment_id', 'creation_time'],
+        'responses': ['creation_time', 'response_id'],
+    }
+    # lightweight "headers only" view of an incident
+    INCIDENT_HEADER_FIELDS = REQUIRED_FIELDS['incidents']
+
     def __init__(self, config: Dict[str, Any]) -> None:
         api_url = config.get('api_url')
         client_id = config.get('client_id')
         ssl_cert = config.get('ssl_cert', False)
         self.period = config['mdr_sync'].get('period', 60)
+        self.scheduler = AdaptiveScheduler(
+            min_period = config['mdr_sync'].get('min_period', min(15, self.period)),
+            max_period = config['mdr_sync'].get('max_period', max(300, self.period)),
+            period = self.period,
+            backoff = config['mdr_sync'].get('backoff', 2)
+        )
         self.data_dir = config.get('data_dir', 'data')
         self.token_dir = config.get('token_dir', 'conf')
+        os.makedirs(get_queue_dir(self.data_dir), exist_ok = True)
+        self.store = get_blob_store(config)
+        self.spool = get_spool(config)
+        self.token_client = TokenClient(self.token_dir)
         self.access_token = self.update_access_token()
         self.filter = config['mdr_sync'].get('filter')
+        self.projection = self.build_projection(self.filter.get('fields'))
         self.download_attachments_size_limit = config['mdr_sync'].get('download_attachments_size_limit')
         self.exclude_author = config['mdr_sync'].get('exclude_author')
-        self.mdr = MDRConsole(api_url = api_url, client_id = client_id, access_token = self.access_token, ssl_cert = ssl_cert)
-        self.max_incidents_at_time = config['mdr_sync'].get('max_incidents_at_time')
+        self.mdr = MDRConsole(api_url = api_url, client_id = client_id, access_token = self.access_token, ssl_cert = ssl_cert, http = config.get('http'), token_provider = self.token_client.get)
+        self.max_incidents_at_time = config['mdr_sync'].get('max_incidents_at_time', 1000)
+        # when the data being parsed has been received from MDR
+        self.fetched_at = time.time()
+        self.page_size = config['mdr_sync'].get('page_size', 100)
+        self.mode = config['mdr_sync'].get('mode', 'incidents')
+        self.retry_attempts = config['mdr_sync'].get('retry_attempts', 5)
     
 
+    def build_projection(self, sinks_fields: Optional[Dict[str, Dict[str, List[str]]]]) -> Dict[str, List[str]]:
+        """
+        Merges per-sink projections into the fields requested for every entity type.
+        Example:
+        sinks_fields = {
+            "kuma": {"incidents": ["summary", "description", "status_description"]},
+            "thehive": {"incidents": ["summary", "affected_hosts_mappings"], "comments": ["text"]}
+        }
+        Entity types which are not listed by any sink are requested in full.
+        """
+        projection = {}
+        for entities in (sinks_fields or {}).values():
+            for entity, fields in entities.items():
+                projection.setdefault(entity, set()).update(fields)
+        return {
+            entity: sorted(fields | set(self.REQUIRED_FIELDS.get(entity, [])))
+            for entity, fields in projection.items()
+        }
+
+
+    def get_fields(self, entity: str) -> Dict[str, List[str]]:
+        # "fields" argument of the list requests, nothing means the full documents
+        if entity in self.projection:
+            return {'fields': self.projection[entity]}
+        return {}
+
+
     def update_access_token(self) -> str:
-        with open(f'{self.token_dir}/.access_token', 'r') as f:
-            access_token = f.read()
-        return access_token
+        # the token broker of the token updater, .access_token if it isn't running
+        return self.token_client.get()
 
 
     def set_last_check(self, last_check: int) -> None:
@@ -45,62 +112,320 @@ class MDRSync():
         return int(last_check)
 
 
-    def get_incidents(self) -> Optional[str]:
-        last_check = self.get_last_check()
-        kwargs = self.filter.get('incidents')
-        kwargs['min_update_time'] = last_check + 1
-        # get count of incidents by filter
-        try:
-            incidents_count = self.mdr.get_incidents_count(**kwargs)['count']
-        except Exception as e:
-            self.logger.exception('Error while getting incidents count')
+    def set_walk(self, walk: Optional[Dict[str, Any]]) -> None:
+        # state of an unfinished headers/full cycle, None when the walk is complete
+        if walk is None:
+            try:
+                os.remove(f'{self.token_dir}/.walk')
+            except FileNotFoundError:
+                pass
             return
-        if incidents_count > self.max_incidents_at_time:
-            self.logger.error(f'Too many incidents are going to be received: {incidents_count} > {self.max_incidents_at_time}')
-            return f'Too many incidents are going to be received: {incidents_count} > {self.max_incidents_at_time}'
+        with open(f'{self.token_dir}/.walk', 'w') as f:
+            json.dump(walk, f)
+
+
+    def get_walk(self) -> Dict[str, Any]:
+        """
+        page_cursor is update_time of the last walked incident, page is above 1 while a group of
+        incidents with the same update_time is paged through, synced keeps update_time of every
+        incident walked so far, it's the watermark of the incident if it changes again before the walk ends.
+        Example:
+        {"page_cursor": 1519640509000, "page": 1, "synced": {"2NJMGXkBNGNeZ5iut24S": 1519640509000}}
+        """
         try:
-            incident_list = self.mdr.get_incidents_list(**kwargs)
-        except Exception as e:
-            self.logger.exception('Error while getting incident list')
-            return
-        for incident in incident_list:
-            # identify updates and push them to data directory
-            self.parse_incident_updates(incident, last_check)
-            # update last_check parameter based on the latest appeared incident
-            if incident['update_time'] > last_check:
-                last_check = incident['update_time']
-        self.set_last_check(last_check)
+            with open(f'{self.token_dir}/.walk', 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def get_incidents(self) -> Optional[int]:
+        """
+        Returns the number of synced incidents, None on errors.
+        Two values are kept: the page cursor only moves min_update_time of the next page,
+        last_check (the sync watermark) tells which incidents and children are new. An incident
+        found on a later page may have been created before the cursor, so it's parsed against
+        last_check, or against its update_time if it has already been walked and changed since.
+        When the walk is cut by max_incidents_at_time or an error, it's kept in .walk and
+        the next cycle resumes it with the same last_check.
+        """
+        last_check = self.get_last_check()
+        walk = self.get_walk()
+        page_cursor = max(walk.get('page_cursor', 0), last_check)
+        synced = walk.get('synced', {})
+        retries = self.get_retries() if self.mode == 'headers' else {}
+        failed = {}
+        kwargs = dict(self.filter.get('incidents') or {})
+        if self.mode == 'headers':
+            # incidents without child arrays, new children are requested only for these incidents
+            kwargs['fields'] = self.projection.get('incidents', self.INCIDENT_FIELDS)
+        elif 'incidents' in self.projection:
+            kwargs['fields'] = self.projection['incidents'] + ['attachments', 'comments', 'responses']
+        kwargs['sort'] = 'update_time:asc'
+        kwargs['page'] = walk.get('page', 1)
+        kwargs['page_size'] = self.page_size
+        received = 0
+        # walk the update_time window page by page, every request starts after the last walked incident
+        while received < self.max_incidents_at_time:
+            # a group with the same update_time is paged through from its own update_time
+            kwargs['min_update_time'] = page_cursor + 1 if kwargs['page'] == 1 else page_cursor
+            try:
+                incident_list = self.mdr.get_incidents_list(**kwargs)
+                self.fetched_at = time.time()
+            except Exception as e:
+                self.logger.exception('Error while getting incident list')
+                return None
+            if kwargs['page'] == 1:
+                page = self.trim_page(incident_list, self.page_size)
+            else:
+                # the rest of the page is walked from the next update_time
+                page = [incident for incident in incident_list if incident['update_time'] == page_cursor]
+            for incident in page:
+                incident_id = incident['incident_id']
+                incident_last_check = synced.get(incident_id, last_check)
+                # identify updates and push them to data directory
+                if self.mode == 'headers':
+                    # second tier: only the new children of the changed incident are requested,
+                    # the types still pending since a failed attempt keep their own watermark
+                    retry = retries.pop(incident_id, None) or failed.pop(incident_id, None) or {'watermarks': {}, 'attempts': 0}
+                    watermarks = {entity_type: incident_last_check for entity_type in self.HISTORY_ENTITY_TYPES}
+                    watermarks.update(retry['watermarks'])
+                    try:
+                        self.parse_entity_updates(incident, watermarks)
+                    except Exception as e:
+                        # the walk goes on, only the failed incident is retried
+                        self.add_retry(failed, incident_id, watermarks, retry['attempts'])
+                else:
+                    self.parse_incident_updates(incident, incident_last_check)
+                synced[incident_id] = incident['update_time']
+            if page:
+                page_cursor = max(page_cursor, page[-1]['update_time'])
+            received += len(page)
+            self.logger.debug(f'incidents page synced: {len(page)} incident(s), page cursor = {page_cursor}')
+            if len(page) < len(incident_list):
+                kwargs['page'] = 1
+            elif len(incident_list) < self.page_size:
+                # the walk is complete, every incident up to the cursor is synced
+                # except the failed ones, those that haven't changed since are retried here
+                for incident_id, retry in retries.items():
+                    try:
+                        self.parse_history_updates(incident_id, retry['watermarks'])
+                    except Exception as e:
+                        self.add_retry(failed, incident_id, retry['watermarks'], retry['attempts'])
+                if self.mode == 'headers':
+                    self.set_retries(failed)
+                self.set_last_check(page_cursor)
+                self.set_walk(None)
+                return received
+            else:
+                # the whole page shares one update_time, the rest of the group is on the next page
+                kwargs['page'] += 1
+            if self.mode == 'headers':
+                self.set_retries({**retries, **failed})
+            self.set_walk({'page_cursor': page_cursor, 'page': kwargs['page'], 'synced': synced})
+        self.logger.info(f'{received} incidents have been synced, the rest will be synced during the next cycle')
+        return received
+
+
+    def trim_page(self, incident_list: List[Dict[str, Any]], page_size: int) -> List[Dict[str, Any]]:
+        # A full page may cut a group of incidents with the same update_time. The tail group
+        # is dropped and requested again with the next page, which starts after the previous update_time.
+        # If the whole page is one group, it's kept and the group is paged through, see get_incidents
+        if len(incident_list) < page_size:
+            return incident_list
+        last_update_time = incident_list[-1]['update_time']
+        page = [incident for incident in incident_list if incident['update_time'] < last_update_time]
+        return page or incident_list
     
 
-    def get_comments(self, incident_id: str) -> Optional[str]:
-        fields = ["author_name", "comment_id", "creation_time", "origin", "text", "was_read"]
-        comments_list = self.mdr.get_comments_list()
+    def set_retries(self, retries: Dict[str, Dict[str, Any]]) -> None:
+        with open(f'{self.token_dir}/.retries', 'w') as f:
+            json.dump(retries, f)
 
 
-    def download_attachment(self, attachment: Dict[str, Any]) -> None:
-        if attachment['file_size'] > self.download_attachments_size_limit:
-            return
-        attachment_id = attachment['attachment_id']
-        filename = attachment['full_name']
+    def get_retries(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Incidents whose updates have failed in history or headers mode, they are synced again
+        during the next cycles, every entity type still pending with the watermark of the window it failed in.
+        Example:
+        {"2NJMGXkBNGNeZ5iut24S": {"watermarks": {"comment": 1519640509000}, "attempts": 1}}
+        """
         try:
-            content = self.mdr.attachments_download(attachment_id = attachment_id)
-        except Exception as e:
-            self.logger.exception('Error while downloading attachment')
+            with open(f'{self.token_dir}/.retries', 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def add_retry(self, retries: Dict[str, Dict[str, Any]], incident_id: str, watermarks: Dict[str, int], attempts: int) -> None:
+        # called from the except block of a failed incident, watermarks are the entity types still pending
+        self.logger.exception(f'Error while getting updates of incident {incident_id}')
+        if attempts + 1 >= self.retry_attempts:
+            self.logger.error(f'updates of incident {incident_id} have failed {attempts + 1} times, they are skipped')
             return
-        with open(f'{self.data_dir}/files/{attachment_id}_{filename}', 'wb') as f:
-            f.write(content)
-            self.logger.info(f'file {filename} has been written to {self.data_dir}/files/{attachment_id}_{filename}')
+        retries[incident_id] = {'watermarks': watermarks, 'attempts': attempts + 1}
+
+
+    def get_history(self) -> Optional[int]:
+        """
+        Returns the number of changed incidents, None on errors. The watermark moves past
+        the window even if some incidents have failed, only the failed ones are kept in
+        .retries, so the incidents already pushed aren't pushed again.
+        """
+        last_check = self.get_last_check()
+        max_record_time = int(time.time() * 1000)
+        # incident_id -> types of the changed entities
+        changes = {}
+        page = 1
+        while True:
+            try:
+                history = self.mdr.get_incidents_history(
+                    min_record_time = last_check + 1,
+                    max_record_time = max_record_time,
+                    entity_type_page_size = self.page_size,
+                    ignore_self = True,
+                    page = page
+                )
+            except Exception as e:
+                self.logger.exception('Error while getting incidents history')
+                return None
+            full_page = False
+            for entity_type, records in self.group_history(history).items():
+                full_page = full_page or len(records) >= self.page_size
+                for record in records:
+                    changes.setdefault(record['incident_id'], set()).add(entity_type)
+            if not full_page:
+                break
+            page += 1
+        self.logger.debug(f'incidents history: {len(changes)} incident(s) changed')
+
+        retries = self.get_retries()
+        # incident_id -> (entity type -> watermark, failed attempts)
+        incidents = {incident_id: ({entity_type: last_check for entity_type in entity_types}, 0) for incident_id, entity_types in changes.items()}
+        for incident_id, retry in retries.items():
+            watermarks, _ = incidents.get(incident_id, ({}, 0))
+            # only the types still pending are synced from the old watermark, its window includes their new changes
+            incidents[incident_id] = ({**watermarks, **retry['watermarks']}, retry['attempts'])
+        failed = {}
+        for incident_id, (watermarks, attempts) in incidents.items():
+            try:
+                self.parse_history_updates(incident_id, watermarks)
+            except Exception as e:
+                self.add_retry(failed, incident_id, watermarks, attempts)
+        self.set_retries(failed)
+        self.set_last_check(max_record_time)
+        if failed and len(failed) == len(incidents):
+            return None
+        return len(incidents) - len(failed)
+
+
+    def group_history(self, history: Union[Dict[str, Any], List[Dict[str, Any]]]) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Groups history records by entity type, the API pages every type separately:
+        {
+            "incident": [{"incident_id": "2NJMGXkBNGNeZ5iut24S", "record_time": 1519640509000, ...}],
+            "comment": [...],
+            "attachment": [...],
+            "response": [...]
+        }
+        """
+        if isinstance(history, list):
+            grouped = {}
+            for record in history:
+                grouped.setdefault(record.get('entity_type', 'incident'), []).append(record)
+            history = grouped
+        result = {}
+        for entity_type, records in history.items():
+            entity_type = entity_type.lower().rstrip('s')
+            if entity_type in self.HISTORY_ENTITY_TYPES and isinstance(records, list):
+                result.setdefault(entity_type, []).extend(records)
+        return result
+
+
+    def parse_history_updates(self, incident_id: str, watermarks: Dict[str, int]) -> None:
+        """
+        watermarks - the changed entity types of the incident and the last_check of each of them:
+        {"incident": 1519640509000, "comment": 1519640509000}
+        """
+        # the incident itself without child arrays, it's needed for filtering anyway.
+        # Only headers are requested if the incident wasn't changed itself.
+        if 'incident' in watermarks:
+            fields = self.projection.get('incidents', self.INCIDENT_FIELDS)
+        else:
+            fields = self.INCIDENT_HEADER_FIELDS
+        incident_data = self.mdr.get_incidents_details(incident_id = incident_id, fields = fields)
+        self.fetched_at = time.time()
+        if not self.match_filter(incident_data):
+            watermarks.clear()
+            return
+        self.parse_entity_updates(incident_data, watermarks)
+
+
+    def parse_entity_updates(self, incident_data: Dict[str, Any], watermarks: Dict[str, int]) -> None:
+        # synced entity types are removed, so a failed incident is retried only for the rest
+        incident_id = incident_data['incident_id']
+        if 'incident' in watermarks:
+            self.parse_incident(incident_data, watermarks['incident'])
+            del watermarks['incident']
+        if 'attachment' in watermarks:
+            last_check = watermarks['attachment']
+            self.parse_attachments(incident_id, self.get_attachments(incident_id, last_check), last_check)
+            del watermarks['attachment']
+        if 'comment' in watermarks:
+            last_check = watermarks['comment']
+            self.parse_comments(incident_id, self.get_comments(incident_id, last_check), last_check)
+            del watermarks['comment']
+        if 'response' in watermarks:
+            last_check = watermarks['response']
+            self.parse_responses(incident_id, self.get_responses(incident_id, last_check), last_check)
+            del watermarks['response']
+
+
+    def match_filter(self, incident_data: Dict[str, Any]) -> bool:
+        # incidents/history has no incident filters, so mdr_sync.filter.incidents is checked locally
+        incidents_filter = self.filter.get('incidents') or {}
+        if 'statuses' in incidents_filter and incident_data.get('status') not in incidents_filter['statuses']:
+            return False
+        if 'priorities' in incidents_filter and incident_data.get('priority') not in incidents_filter['priorities']:
+            return False
+        if incident_data.get('creation_time', 0) < incidents_filter.get('min_creation_time', 0):
+            return False
+        return True
+
+
+    def get_attachments(self, incident_id: str, last_check: int) -> List[Dict[str, Any]]:
+        attachments = self.mdr.get_attachments_list(incident_id = incident_id, min_creation_time = last_check + 1, **self.get_fields('attachments'))
+        self.fetched_at = time.time()
+        return attachments
+
+
+    def get_comments(self, incident_id: str, last_check: int) -> List[Dict[str, Any]]:
+        comments = self.mdr.get_comments_list(incident_id = incident_id, min_creation_time = last_check + 1, **self.get_fields('comments'))
+        self.fetched_at = time.time()
+        return comments
+
+
+    def get_responses(self, incident_id: str, last_check: int) -> List[Dict[str, Any]]:
+        responses = self.mdr.get_responses_list(incident_id = incident_id, min_creation_time = last_check + 1, **self.get_fields('responses'))
+        self.fetched_at = time.time()
+        return responses
+
 
     def parse_incident_updates(self, incident_data: Dict[str, Any], last_check: int) -> Dict[str, Any]:
+        incident_id = incident_data['incident_id']
+        attachments = incident_data.pop('attachments', [])
+        comments = incident_data.pop('comments', [])
+        responses = incident_data.pop('responses', [])
+        self.parse_incident(incident_data, last_check)
+        self.parse_attachments(incident_id, attachments, last_check)
+        self.parse_comments(incident_id, comments, last_check)
+        self.parse_responses(incident_id, responses, last_check)
+
+
+    def parse_incident(self, incident_data: Dict[str, Any], last_check: int) -> None:
         incident_id = incident_data['incident_id']
         creation_time = incident_data['creation_time']
         update_time = incident_data['update_time']
-        attachments = incident_data.get('attachments')
-        incident_data.pop('attachments')
-        comments = incident_data.get('comments')
-        incident_data.pop('comments')
-        responses = incident_data.get('responses')
-        incident_data.pop('responses')
         # Check if it's the new incident
         if creation_time == update_time or creation_time > last_check:
             self.logger.info(f'new incident found. incident_id = {incident_id}, creation_time = {creation_time}')
@@ -109,7 +434,9 @@ class MDRSync():
         if update_time > last_check:
             self.logger.info(f'incident update found. incident_id = {incident_id}, update_time = {update_time}')
             self.push_updates('update_incident', update_time, incident_data)
-        # Check updates in attachments
+
+
+    def parse_attachments(self, incident_id: str, attachments: List[Dict[str, Any]], last_check: int) -> None:
         for attachment in attachments: 
             if attachment['creation_time'] > last_check:  # attachment['was_read'] == False
                 self.logger.info(f'new attachment found. incident_id = {incident_id}, filename = {attachment["full_name"]}, creation_time = {attachment["creation_time"]}')
@@ -120,9 +447,18 @@ class MDRSync():
                 }
                 if re.match(self.exclude_author, attachment['author_name']):
                     continue
-                self.push_updates('new_attachment', attachment_creation_time, attachment_data)
-                self.download_attachment(attachment)
-        # Check updates in comments
+                if self.download_attachments_size_limit is not None and attachment['file_size'] > self.download_attachments_size_limit:
+                    self.push_updates('new_attachment', attachment_creation_time, attachment_data)
+                elif self.store.contains(attachment['attachment_id']):
+                    self.logger.info(f'attachment {attachment["attachment_id"]} is already in the attachment store')
+                    self.push_updates('new_attachment', attachment_creation_time, attachment_data)
+                else:
+                    # the update is pushed by AttachmentDownloader once the file is stored
+                    enqueue_download(self.data_dir, attachment_creation_time, self.add_trace(attachment_creation_time, attachment_data))
+                    self.logger.info(f'attachment {attachment["attachment_id"]} has been queued for download')
+
+
+    def parse_comments(self, incident_id: str, comments: List[Dict[str, Any]], last_check: int) -> None:
         for comment in comments: 
             if comment['creation_time'] > last_check:  # comment['was_read'] == False
                 self.logger.info(f'new comment found. incident_id = {incident_id}, from = {comment["author_name"]}, creation_time = {comment["creation_time"]}')
@@ -134,7 +470,9 @@ class MDRSync():
                 if re.match(self.exclude_author, comment['author_name']):
                     continue
                 self.push_updates('new_comment', comment_creation_time, comment_data)
-        # Check updates in responses
+
+
+    def parse_responses(self, incident_id: str, responses: List[Dict[str, Any]], last_check: int) -> None:
         for response in responses:
             if response['creation_time'] > last_check:  # response['was_read'] == False 
                 self.logger.info(f'new response found. incident_id = {incident_id}, creation_time = {response["creation_time"]}')
@@ -146,21 +484,41 @@ class MDRSync():
                 self.push_updates('new_response', response_creation_time, response_data)
 
 
+    def add_trace(self, timestamp: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        # the spool adds written_at, the sinks report the latency of every stage on delivery
+        return dict(data, _trace = {'event_time': timestamp / 1000, 'fetched_at': self.fetched_at})
+
+
     def push_updates(self, update_type: str, timestamp: int, data: Dict[str, Any]) -> None:
-        timestamp = str(timestamp)
-        filename = f'{timestamp}_{update_type}.json'
-        with open(f'{self.data_dir}/{filename}', 'w') as f:
-            json.dump(data, f)
-            self.logger.info(f'An update has been writen to {filename}')
+        filename = self.spool.push(update_type, timestamp, self.add_trace(timestamp, data))
+        metrics.inc('mdr_sync_updates_total', update_type = update_type)
+        self.logger.info(f'An update has been writen to {filename}')
     
 
     def run(self, logging_queue, logging_configurer):
         logging_configurer(logging_queue)
         self.logger = logging.getLogger(__name__)
         self.logger.info('started')
+        metrics.register_gauge('mdr_sync_last_check_age_seconds', lambda: time.time() - self.get_last_check() / 1000)
         while True:
             self.logger.info('getting updates from MDR..')
-            self.mdr.access_token = self.update_access_token()
-            self.get_incidents()
-            self.logger.info('getting updates finished')
-            time.sleep(self.period)
\ No newline at end of file
+            started = time.monotonic()
+            try:
+                self.mdr.access_token = self.update_access_token()
+                if self.mode == 'history':
+                    updates = self.get_history()
+                else:
+                    updates = self.get_incidents()
+            except Exception as e:
+                self.logger.exception('Error while getting updates from MDR')
+                updates = None
+            duration = time.monotonic() - started
+            metrics.observe('mdr_sync_cycle_seconds', duration)
+            metrics.inc('mdr_sync_cycles_total', result = 'error' if updates is None else 'ok')
+            metrics.set_gauge('mdr_sync_incidents_per_cycle', updates or 0)
+            metrics.set_ready(updates is not None)
+            # polls often while incidents change, backs off when idle or failing
+            delay = self.scheduler.next_delay(updates, duration)
+            metrics.heartbeat(delay)
+            self.logger.info(f'getting updates finished, {updates} incident(s) synced, the next cycle in {delay:.0f}s')
+            time.sleep(delay)
\ No newline at end of file
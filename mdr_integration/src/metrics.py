@@ -0,0 +1,336 @@
+"""
+Metrics of the service processes. Every process records its metrics locally,
+a background thread sends the changes to the metrics queue every flush_interval
+seconds, MetricsServer in main.py aggregates them and serves /metrics in the
+Prometheus text format, /healthz and /readyz.
+Example:
+metrics.inc('sink_updates_total', sink = 'kuma', result = 'processed')
+with metrics.timer('mdr_api_request_seconds', path = 'incidents/list'):
+    ...
+metrics.heartbeat(60)  # the process reports again within 60 seconds
+metrics.sample('update_latency_seconds', 12.5, stage = 'total')  # summary with quantiles
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import collections
+import logging
+import threading
+import contextlib
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Dict, Any, List, Tuple, Callable
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+SAMPLES_PER_FLUSH = 1000
+
+_lock = threading.Lock()
+_queue = None
+_process = None
+_counters = {}
+_gauges = {}
+_histograms = {}
+_samples = {}
+_callbacks = []
+_state = {'ready': False, 'heartbeat': None}
+
+
+def get_key(name: str, labels: Dict[str, Any]) -> Tuple:
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    key = get_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _lock:
+        _gauges[get_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    key = get_key(name, labels)
+    with _lock:
+        histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0, 0])
+        for number, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[0][number] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def sample(name: str, value: float, **labels) -> None:
+    # raw values for the quantiles of a summary, at most SAMPLES_PER_FLUSH are sent per flush
+    key = get_key(name, labels)
+    with _lock:
+        values = _samples.setdefault(key, [0, []])
+        values[0] += 1
+        if len(values[1]) < SAMPLES_PER_FLUSH:
+            values[1].append(value)
+        else:
+            # reservoir sampling keeps a uniform sample of the flush interval
+            index = random.randrange(values[0])
+            if index < SAMPLES_PER_FLUSH:
+                values[1][index] = value
+
+
+@contextlib.contextmanager
+def timer(name: str, **labels):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+
+def register_gauge(name: str, callback: Callable[[], Optional[float]], interval: float = 0, **labels) -> None:
+    """
+    callback is evaluated by the flush thread, not more often than every interval seconds
+    """
+    with _lock:
+        _callbacks.append({'name': name, 'labels': labels, 'callback': callback, 'interval': interval, 'last': 0})
+
+
+def heartbeat(next_within: float) -> None:
+    # liveness, the process promises to report again within next_within seconds
+    _state['heartbeat'] = (time.time(), next_within)
+
+
+def set_ready(ready: bool = True) -> None:
+    _state['ready'] = ready
+
+
+def configure(metrics_queue: Any, process: Optional[str] = None, flush_interval: float = 5) -> None:
+    # called once in every process, metrics recorded before are sent too
+    global _queue, _process
+    if metrics_queue is None:
+        return
+    _queue = metrics_queue
+    _process = process or multiprocessing.current_process().name
+    threading.Thread(target = flush_loop, args = (flush_interval,), daemon = True).start()
+
+
+def evaluate_callbacks() -> None:
+    now = time.monotonic()
+    for callback in list(_callbacks):
+        if now - callback['last'] < callback['interval']:
+            continue
+        callback['last'] = now
+        try:
+            value = callback['callback']()
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"metric {callback['name']} can't be evaluated: {e}")
+            continue
+        if value is not None:
+            set_gauge(callback['name'], value, **callback['labels'])
+
+
+def flush() -> None:
+    global _counters, _histograms, _samples
+    evaluate_callbacks()
+    with _lock:
+        counters, histograms, samples, gauges = _counters, _histograms, _samples, dict(_gauges)
+        _counters, _histograms, _samples = {}, {}, {}
+    message = {
+        'process': _process,
+        'pid': os.getpid(),
+        'time': time.time(),
+        'ready': _state['ready'],
+        'heartbeat': _state['heartbeat'],
+        'counters': list(counters.items()),
+        'gauges': list(gauges.items()),
+        'histograms': list(histograms.items()),
+        'samples': [(key, values) for key, (count, values) in samples.items()],
+    }
+    try:
+        _queue.put_nowait(message)
+    except queue.Full:
+        # the changes are kept for the next flush
+        with _lock:
+            for key, value in counters.items():
+                _counters[key] = _counters.get(key, 0) + value
+            for key, (buckets, total, count) in histograms.items():
+                histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+
+
+def flush_loop(flush_interval: float) -> None:
+    while True:
+        time.sleep(flush_interval)
+        try:
+            flush()
+        except Exception as e:
+            logging.getLogger(__name__).exception('Error while sending metrics')
+
+
+class MetricsServer():
+    """
+    Aggregates the metrics of all processes and serves them over HTTP:
+    /metrics - Prometheus text format
+    /healthz - 200 if every watched process is running and reported in time
+    /readyz - 200 if every watched process is healthy and ready
+    """
+
+    def __init__(self, metrics_queue: Any, host: str = '127.0.0.1', port: int = 9108, grace: float = 60, window: int = 10000) -> None:
+        """
+        grace - seconds a heartbeat may be late
+        window - the quantiles of a summary are computed over so many latest samples
+        """
+        self.queue = metrics_queue
+        self.host = host
+        self.port = port
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.window = window
+        self.samples = {}
+        self.processes = {}
+        self.watched = {}
+
+
+    def watch(self, name: str, process: multiprocessing.Process) -> None:
+        self.watched[name] = process
+
+
+    def collect(self) -> None:
+        while True:
+            message = self.queue.get()
+            with self.lock:
+                for key, value in message['counters']:
+                    self.counters[key] = self.counters.get(key, 0) + value
+                for key, value in message['gauges']:
+                    self.gauges[(key[0], key[1] + (('process', message['process']),))] = value
+                for key, (buckets, total, count) in message['histograms']:
+                    histogram = self.histograms.setdefault(key, [[0] * len(BUCKETS), 0, 0])
+                    histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                    histogram[1] += total
+                    histogram[2] += count
+                for key, values in message.get('samples', []):
+                    self.samples.setdefault(key, collections.deque(maxlen = self.window)).extend(values)
+                self.processes[message['process']] = message
+
+
+    def get_status(self) -> Dict[str, Dict[str, Any]]:
+        now = time.time()
+        status = {}
+        with self.lock:
+            for name, process in self.watched.items():
+                message = self.processes.get(name) or {}
+                heartbeat = message.get('heartbeat')
+                alive = process.is_alive()
+                live = alive and heartbeat is not None and now <= heartbeat[0] + heartbeat[1] + self.grace
+                status[name] = {
+                    'alive': alive,
+                    'live': live,
+                    'ready': live and bool(message.get('ready')),
+                    'last_report': message.get('time'),
+                }
+        return status
+
+
+    def format_labels(self, labels: Tuple, extra: Tuple = ()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in items]
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+
+        def add_type(name, metric_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {metric_type}')
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                add_type(name, 'counter')
+                lines.append(f'{name}{self.format_labels(labels)} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                add_type(name, 'gauge')
+                lines.append(f'{name}{self.format_labels(labels)} {value}')
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                add_type(name, 'histogram')
+                for bound, bucket in zip(BUCKETS, buckets):
+                    lines.append(f'{name}_bucket{self.format_labels(labels, (("le", str(bound)),))} {bucket}')
+                lines.append(f'{name}_bucket{self.format_labels(labels, (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{self.format_labels(labels)} {total}')
+                lines.append(f'{name}_count{self.format_labels(labels)} {count}')
+            for (name, labels), values in sorted(self.samples.items()):
+                add_type(name, 'summary')
+                ordered = sorted(values)
+                for quantile in QUANTILES:
+                    value = ordered[min(int(quantile * len(ordered)), len(ordered) - 1)] if ordered else 'NaN'
+                    lines.append(f'{name}{self.format_labels(labels, (("quantile", str(quantile)),))} {value}')
+                lines.append(f'{name}_sum{self.format_labels(labels)} {sum(ordered)}')
+                lines.append(f'{name}_count{self.format_labels(labels)} {len(ordered)}')
+        for name, status in self.get_status().items():
+            for state in ('alive', 'live', 'ready'):
+                add_type(f'process_{state}', 'gauge')
+                lines.append(f'process_{state}{self.format_labels((("process", name),))} {int(status[state])}')
+        return '\n'.join(lines) + '\n'
+
+
+    def get_quantiles(self, name: str) -> Dict[str, Dict[str, float]]:
+        # labels -> quantile -> value, for the logs and benchmarks
+        result = {}
+        with self.lock:
+            for (metric, labels), values in self.samples.items():
+                if metric != name or not values:
+                    continue
+                ordered = sorted(values)
+                result[','.join(f'{key}={value}' for key, value in labels)] = {
+                    f'p{int(quantile * 100)}': ordered[min(int(quantile * len(ordered)), len(ordered) - 1)] for quantile in QUANTILES
+                }
+        return result
+
+
+    def get_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    self.reply(200, server.render(), 'text/plain; version=0.0.4')
+                elif self.path in ('/healthz', '/readyz'):
+                    status = server.get_status()
+                    state = 'live' if self.path == '/healthz' else 'ready'
+                    code = 200 if all(process[state] for process in status.values()) else 503
+                    self.reply(code, json.dumps(status, indent = 2), 'application/json')
+                else:
+                    self.reply(404, 'not found\n', 'text/plain')
+
+            def reply(self, code, body, content_type):
+                body = body.encode()
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+    def serve_forever(self) -> None:
+        threading.Thread(target = self.collect, daemon = True).start()
+        httpd = ThreadingHTTPServer((self.host, self.port), self.get_handler())
+        logging.getLogger(__name__).info(f'metrics are served on http://{self.host}:{self.port}/metrics')
+        httpd.serve_forever()
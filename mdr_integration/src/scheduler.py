@@ -0,0 +1,41 @@
+import time
+import random
+from typing import Optional
+
+
+class AdaptiveScheduler():
+    """
+    Interval between polling cycles. The interval drops to min_period as soon as
+    a cycle brings updates, grows backoff times per idle cycle and per failed cycle
+    up to max_period. The duration of the cycle is subtracted, so the cycles
+    start every interval seconds instead of drifting.
+    Example:
+    scheduler = AdaptiveScheduler(min_period = 15, max_period = 300, period = 60)
+    while True:
+        started = time.monotonic()
+        updates = poll()  # None on errors
+        time.sleep(scheduler.next_delay(updates, time.monotonic() - started))
+    """
+
+    def __init__(self, min_period: float, max_period: float, period: Optional[float] = None, backoff: float = 2, jitter: float = 0.1) -> None:
+        """
+        period - the first interval, min_period by default
+        jitter - a random part of the interval, 0.1 means up to 10%
+        """
+        self.min_period = min_period
+        self.max_period = max(min_period, max_period)
+        self.backoff = backoff
+        self.jitter = jitter
+        self.interval = min(max(period or min_period, self.min_period), self.max_period)
+
+
+    def next_delay(self, updates: Optional[int], duration: float = 0) -> float:
+        """
+        updates - how many updates the cycle brought, None if it failed
+        """
+        if updates:
+            self.interval = self.min_period
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_period)
+        interval = self.interval * (1 + random.uniform(0, self.jitter))
+        return max(interval - duration, 0)
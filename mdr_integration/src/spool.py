@@ -0,0 +1,276 @@
+import os
+import re
+import glob
+import json
+import time
+import sqlite3
+import threading
+from typing import Optional, Dict, Any, List
+
+from src.spool_watcher import SpoolWatcher, PUSH_MARKER
+
+
+def stamp_trace(data: Dict[str, Any]) -> Dict[str, Any]:
+    # the latency trace of the update gets the time it's written to the spool
+    if '_trace' not in data:
+        return data
+    return dict(data, _trace = dict(data['_trace'], written_at = time.time()))
+
+
+class FileSpool():
+    """
+    Updates are stored as {timestamp}_{incident_id}_{update_type}.json files in data_dir,
+    updates of comments, attachments and responses as {timestamp}_{incident_id}_{entity_id}_{update_type}.json,
+    so children created in the same millisecond don't overwrite each other. Processed
+    ones are renamed to *.json.processed. written_at of a claimed update is
+    the modification time of its file.
+    """
+
+    # the incident_id group includes the entity_id of children, the record takes incident_id from the data
+    FILENAME_PATTERN = re.compile(r'^(?P<timestamp>\d+)_(?:(?P<incident_id>.+)_)?(?P<update_type>new_incident|update_incident|new_attachment|new_comment|new_response)\.json$')
+
+    ENTITY_ID_FIELDS = {
+        'new_attachment': ('attachments', 'attachment_id'),
+        'new_comment': ('comments', 'comment_id'),
+        'new_response': ('responses', 'response_id'),
+    }
+
+    def __init__(self, data_dir: str) -> None:
+        self.data_dir = data_dir
+
+
+    def get_filename(self, update_type: str, timestamp: int, data: Dict[str, Any]) -> str:
+        if update_type in self.ENTITY_ID_FIELDS:
+            entity, field = self.ENTITY_ID_FIELDS[update_type]
+            entity_id = (data.get(entity) or [{}])[0].get(field)
+            if entity_id:
+                return f"{timestamp}_{data['incident_id']}_{entity_id}_{update_type}.json"
+        return f"{timestamp}_{data['incident_id']}_{update_type}.json"
+
+
+    def push(self, update_type: str, timestamp: int, data: Dict[str, Any]) -> str:
+        data = stamp_trace(data)
+        # the file is renamed into place, so consumers never read a half-written update
+        filename = self.get_filename(update_type, timestamp, data)
+        tmp_path = f'{self.data_dir}/.{filename}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, f'{self.data_dir}/{filename}')
+        return filename
+
+
+    def claim(self, batch_size: Optional[int] = None) -> List[Dict[str, Any]]:
+        updates = []
+        for path in sorted(glob.glob(f'{self.data_dir}/*.json')):
+            match = self.FILENAME_PATTERN.match(os.path.basename(path))
+            if not match:
+                continue
+            with open(path, 'r') as f:
+                data = json.load(f)
+                written_at = os.fstat(f.fileno()).st_mtime
+            updates.append({
+                'id': path,
+                'update_type': match['update_type'],
+                'timestamp': int(match['timestamp']),
+                'incident_id': data.get('incident_id'),
+                'data': data,
+                'written_at': written_at
+            })
+            if batch_size and len(updates) >= batch_size:
+                break
+        return updates
+
+
+    def ack(self, update: Dict[str, Any]) -> None:
+        os.rename(update['id'], f"{update['id']}.processed")
+
+
+    def release(self, update: Dict[str, Any]) -> None:
+        # the file stays in data_dir and is claimed again during the next scan
+        pass
+
+
+    def get_processed(self, batch_size: int, min_age: float = 0) -> List[Dict[str, Any]]:
+        # processed updates for the archive, renaming the file updates its ctime
+        updates = []
+        max_ctime = time.time() - min_age
+        with os.scandir(self.data_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json.processed'):
+                    continue
+                match = self.FILENAME_PATTERN.match(entry.name[:-len('.processed')])
+                stat = entry.stat()
+                if not match or stat.st_ctime > max_ctime:
+                    continue
+                with open(entry.path, 'r') as f:
+                    data = json.load(f)
+                updates.append({
+                    'id': entry.path,
+                    'update_type': match['update_type'],
+                    'timestamp': int(match['timestamp']),
+                    'incident_id': data.get('incident_id'),
+                    'data': data,
+                    'processed_at': stat.st_ctime
+                })
+                if len(updates) >= batch_size:
+                    break
+        return updates
+
+
+    def count(self, status: str = 'pending') -> int:
+        suffix = '.json' if status == 'pending' else '.json.processed'
+        with os.scandir(self.data_dir) as entries:
+            return sum(1 for entry in entries if entry.name.endswith(suffix) and not entry.name.startswith('.'))
+
+
+    def purge(self, updates: List[Dict[str, Any]]) -> None:
+        for update in updates:
+            try:
+                os.remove(update['id'])
+            except FileNotFoundError:
+                pass
+
+
+class SQLiteOutbox():
+    """
+    Updates are stored in {data_dir}/outbox.db (SQLite in WAL mode). Consumers claim
+    a batch of pending updates, then ack or release every update. Claims of a crashed
+    consumer expire after claim_timeout seconds.
+    """
+
+    def __init__(self, data_dir: str, claim_timeout: int = 600) -> None:
+        self.path = f'{data_dir}/outbox.db'
+        self.marker = f'{data_dir}/{PUSH_MARKER}'
+        self.claim_timeout = claim_timeout
+        conn = sqlite3.connect(self.path, timeout = 30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS updates ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, update_type TEXT NOT NULL, timestamp INTEGER NOT NULL, '
+                'incident_id TEXT, data TEXT NOT NULL, status TEXT NOT NULL DEFAULT \'pending\', '
+                'created REAL NOT NULL, claimed_at REAL, processed_at REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS updates_status ON updates (status, timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS updates_incident_id ON updates (incident_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS updates_timestamp ON updates (timestamp)')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+    def connection(self) -> sqlite3.Connection:
+        # one connection per thread and process, it's opened lazily so the outbox can be passed to a child process
+        if '_local' not in self.__dict__:
+            self._local = threading.local()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state.pop('_local', None)
+        return state
+
+
+    def push(self, update_type: str, timestamp: int, data: Dict[str, Any]) -> str:
+        data = stamp_trace(data)
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.execute(
+                'INSERT INTO updates (update_type, timestamp, incident_id, data, created) VALUES (?, ?, ?, ?, ?)',
+                (update_type, timestamp, data.get('incident_id'), json.dumps(data), time.time())
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        # wakes the SpoolWatcher of the sinks, closing the file is an inotify event, utime is seen by polling
+        open(self.marker, 'a').close()
+        os.utime(self.marker)
+        return f'outbox.db#{cursor.lastrowid}'
+
+
+    def claim(self, batch_size: Optional[int] = None) -> List[Dict[str, Any]]:
+        conn = self.connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, update_type, timestamp, incident_id, data, created FROM updates '
+                'WHERE status = \'pending\' OR (status = \'claimed\' AND claimed_at < ?) '
+                'ORDER BY timestamp, id LIMIT ?',
+                (now - self.claim_timeout, batch_size or -1)
+            ).fetchall()
+            conn.executemany('UPDATE updates SET status = \'claimed\', claimed_at = ? WHERE id = ?', [(now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [
+            {'id': row[0], 'update_type': row[1], 'timestamp': row[2], 'incident_id': row[3], 'data': json.loads(row[4]), 'written_at': row[5]}
+            for row in rows
+        ]
+
+
+    def ack(self, update: Dict[str, Any]) -> None:
+        self.connection().execute('UPDATE updates SET status = \'processed\', processed_at = ? WHERE id = ?', (time.time(), update['id']))
+
+
+    def release(self, update: Dict[str, Any]) -> None:
+        self.connection().execute('UPDATE updates SET status = \'pending\', claimed_at = NULL WHERE id = ?', (update['id'],))
+
+
+    def get_processed(self, batch_size: int, min_age: float = 0) -> List[Dict[str, Any]]:
+        rows = self.connection().execute(
+            'SELECT id, update_type, timestamp, incident_id, data, processed_at FROM updates '
+            'WHERE status = \'processed\' AND processed_at < ? ORDER BY id LIMIT ?',
+            (time.time() - min_age, batch_size)
+        ).fetchall()
+        return [
+            {'id': row[0], 'update_type': row[1], 'timestamp': row[2], 'incident_id': row[3], 'data': json.loads(row[4]), 'processed_at': row[5]}
+            for row in rows
+        ]
+
+
+    def count(self, status: str = 'pending') -> int:
+        # claimed updates are counted as pending
+        statuses = ('pending', 'claimed') if status == 'pending' else (status,)
+        return self.connection().execute(
+            f"SELECT COUNT(*) FROM updates WHERE status IN ({','.join('?' * len(statuses))})", statuses
+        ).fetchone()[0]
+
+
+    def purge(self, updates: List[Dict[str, Any]]) -> None:
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('DELETE FROM updates WHERE id = ?', [(update['id'],) for update in updates])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+
+def get_spool(config: Dict[str, Any]) -> Any:
+    spool_config = config.get('spool') or {}
+    data_dir = config.get('data_dir', 'data')
+    if spool_config.get('type', 'files') == 'sqlite':
+        return SQLiteOutbox(data_dir, claim_timeout = spool_config.get('claim_timeout', 600))
+    return FileSpool(data_dir)
+
+
+def get_spool_watcher(config: Dict[str, Any]) -> SpoolWatcher:
+    spool_config = config.get('spool') or {}
+    return SpoolWatcher(
+        config.get('data_dir', 'data'),
+        debounce = spool_config.get('debounce', 0.2),
+        poll_interval = spool_config.get('poll_interval', 1)
+    )
@@ -0,0 +1,176 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import datetime
+import contextlib
+from typing import Optional, Dict, Any, List
+
+from src.spool import get_spool
+from src import metrics
+
+
+class SpoolCompactor():
+    """
+    Moves processed updates out of the spool into compressed, time-bucketed archive
+    segments data_dir/archive/{bucket}/{segment}.jsonl.gz. The archive index
+    (data_dir/archive/index.db) maps every update to its segment and line.
+    The compactor only touches processed updates, so it never competes with the sinks
+    for pending ones, and it works in small batches with short transactions.
+    """
+
+    BUCKET_FORMATS = {
+        'hour': '%Y-%m-%d_%H',
+        'day': '%Y-%m-%d',
+    }
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        compactor_config = config.get('spool_compactor') or {}
+        self.period = compactor_config.get('period', 600)
+        self.batch_size = compactor_config.get('batch_size', 1000)
+        self.min_age = compactor_config.get('min_age', 3600)
+        self.retention_days = compactor_config.get('retention_days', 90)
+        self.bucket_format = self.BUCKET_FORMATS[compactor_config.get('bucket', 'day')]
+        self.archive_dir = f"{config.get('data_dir', 'data')}/archive"
+        self.spool = get_spool(config)
+        os.makedirs(self.archive_dir, exist_ok = True)
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS segments (segment TEXT PRIMARY KEY, bucket_time REAL, created REAL)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS records (name TEXT PRIMARY KEY, update_type TEXT, incident_id TEXT, '
+                'timestamp INTEGER, segment TEXT, line INTEGER)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS records_incident_id ON records (incident_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS records_segment ON records (segment)')
+            conn.execute('CREATE INDEX IF NOT EXISTS segments_bucket_time ON segments (bucket_time)')
+
+
+    @contextlib.contextmanager
+    def connect(self):
+        conn = sqlite3.connect(f'{self.archive_dir}/index.db', timeout = 30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+    def get_name(self, update: Dict[str, Any]) -> str:
+        if isinstance(update['id'], int):
+            return f"outbox.db#{update['id']}"
+        return os.path.basename(update['id'])
+
+
+    def compact(self) -> int:
+        archived = 0
+        while True:
+            updates = self.spool.get_processed(self.batch_size, self.min_age)
+            if not updates:
+                return archived
+            buckets = {}
+            for update in updates:
+                bucket_time = datetime.datetime.fromtimestamp(update['timestamp'] / 1000, tz = datetime.timezone.utc)
+                bucket = bucket_time.strftime(self.bucket_format)
+                buckets.setdefault(bucket, []).append(update)
+            for bucket, bucket_updates in buckets.items():
+                self.write_segment(bucket, bucket_updates)
+            # originals are removed only when their segment and index rows are written
+            self.spool.purge(updates)
+            archived += len(updates)
+            if len(updates) < self.batch_size:
+                return archived
+
+
+    def write_segment(self, bucket: str, updates: List[Dict[str, Any]]) -> str:
+        os.makedirs(f'{self.archive_dir}/{bucket}', exist_ok = True)
+        segment = f'{bucket}/{time.time_ns()}.jsonl.gz'
+        tmp_path = f'{self.archive_dir}/{segment}.tmp'
+        with gzip.open(tmp_path, 'wt') as f:
+            for update in updates:
+                record = {
+                    'name': self.get_name(update),
+                    'update_type': update['update_type'],
+                    'timestamp': update['timestamp'],
+                    'incident_id': update['incident_id'],
+                    'processed_at': update.get('processed_at'),
+                    'data': update['data'],
+                }
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, f'{self.archive_dir}/{segment}')
+        bucket_time = datetime.datetime.strptime(bucket, self.bucket_format).replace(tzinfo = datetime.timezone.utc).timestamp()
+        with self.connect() as conn:
+            conn.execute('INSERT INTO segments (segment, bucket_time, created) VALUES (?, ?, ?)', (segment, bucket_time, time.time()))
+            conn.executemany(
+                'INSERT OR REPLACE INTO records (name, update_type, incident_id, timestamp, segment, line) VALUES (?, ?, ?, ?, ?, ?)',
+                [(self.get_name(update), update['update_type'], update['incident_id'], update['timestamp'], segment, line) for line, update in enumerate(updates)]
+            )
+        return segment
+
+
+    def expire(self) -> int:
+        expired = 0
+        with self.connect() as conn:
+            segments = conn.execute('SELECT segment FROM segments WHERE bucket_time < ?', (time.time() - self.retention_days * 86400,)).fetchall()
+            for (segment,) in segments:
+                conn.execute('DELETE FROM records WHERE segment = ?', (segment,))
+                conn.execute('DELETE FROM segments WHERE segment = ?', (segment,))
+                try:
+                    os.remove(f'{self.archive_dir}/{segment}')
+                except FileNotFoundError:
+                    pass
+                expired += 1
+        # drop emptied bucket directories
+        for bucket in os.listdir(self.archive_dir):
+            bucket_dir = f'{self.archive_dir}/{bucket}'
+            if os.path.isdir(bucket_dir) and not os.listdir(bucket_dir):
+                shutil.rmtree(bucket_dir, ignore_errors = True)
+        return expired
+
+
+    def read_record(self, segment: str, line: int) -> Optional[Dict[str, Any]]:
+        with gzip.open(f'{self.archive_dir}/{segment}', 'rt') as f:
+            for number, record in enumerate(f):
+                if number == line:
+                    return json.loads(record)
+        return None
+
+
+    def lookup(self, name: str) -> Optional[Dict[str, Any]]:
+        # name is the spool file name or outbox.db#<id>
+        with self.connect() as conn:
+            row = conn.execute('SELECT segment, line FROM records WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return self.read_record(*row)
+
+
+    def find(self, incident_id: str) -> List[Dict[str, Any]]:
+        with self.connect() as conn:
+            rows = conn.execute('SELECT segment, line FROM records WHERE incident_id = ? ORDER BY timestamp', (incident_id,)).fetchall()
+        return [self.read_record(segment, line) for segment, line in rows]
+
+
+    def run(self, logging_queue, logging_configurer) -> None:
+        logging_configurer(logging_queue)
+        self.logger = logging.getLogger(__name__)
+        self.logger.info('started')
+        # background work, the sinks keep the CPU and disk priority
+        if hasattr(os, 'nice'):
+            os.nice(10)
+        # the spool is counted here, not in the sinks, scanning data_dir is a background job too
+        for status in ('pending', 'processed'):
+            metrics.register_gauge('spool_updates', lambda status = status: self.spool.count(status), interval = 30, status = status)
+        metrics.set_ready()
+        while True:
+            try:
+                archived = self.compact()
+                expired = self.expire()
+                self.logger.info(f'spool compaction finished: {archived} update(s) archived, {expired} segment(s) expired')
+            except Exception as e:
+                self.logger.exception('Error while compacting the spool')
+            metrics.heartbeat(self.period)
+            time.sleep(self.period)
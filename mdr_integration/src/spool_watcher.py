@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+from typing import Optional, Tuple
+
+# touched by SQLiteOutbox.push, writes of the consumers to outbox.db don't wake them up
+PUSH_MARKER = 'outbox.pushed'
+
+class SpoolWatcher():
+    """
+    Wakes a sink up as soon as MDR sync pushes an update to data_dir. inotify is
+    used on Linux, other platforms poll the modification time of data_dir and of
+    the push marker of the SQLite outbox.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, path: str, debounce: float = 0.2, poll_interval: float = 1) -> None:
+        """
+        debounce - after the first event more events are collected during this time
+        poll_interval - seconds between checks when inotify is not available
+        """
+        self.path = path
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.signature = None
+
+
+    def start(self) -> None:
+        # called in the consumer process, the inotify descriptor can't be inherited
+        self.fd = self.init_inotify()
+        if self.fd is None:
+            self.signature = self.get_signature()
+
+
+    def init_inotify(self) -> Optional[int]:
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(self.path), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+
+    def is_update(self, name: str) -> bool:
+        return (name.endswith('.json') and not name.startswith('.')) or name == PUSH_MARKER
+
+
+    def read_events(self) -> bool:
+        # drains the inotify descriptor, returns True if any update has been written
+        found = False
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return found
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+                offset += self.EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b'\0').decode(errors = 'replace')
+                offset += length
+                found = found or self.is_update(name)
+
+
+    def get_signature(self) -> Tuple:
+        signature = []
+        for path in (self.path, f'{self.path}/{PUSH_MARKER}'):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Blocks until new updates are written or the timeout expires.
+        Returns True if it was woken by an update.
+        """
+        if self.fd is None and self.signature is None:
+            self.start()
+        deadline = time.monotonic() + timeout
+        if self.fd is not None:
+            woken = False
+            while not woken:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                readable, _, _ = select.select([self.fd], [], [], remaining)
+                if readable:
+                    woken = self.read_events()
+            # let a burst of updates settle into one batch
+            time.sleep(self.debounce)
+            self.read_events()
+            return True
+        while time.monotonic() < deadline:
+            time.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+            signature = self.get_signature()
+            if signature != self.signature:
+                self.signature = signature
+                time.sleep(self.debounce)
+                self.signature = self.get_signature()
+                return True
+        return False
@@ -0,0 +1,100 @@
+import os
+import logging
+import threading
+import multiprocessing.connection
+from typing import Optional, Callable
+
+SOCKET_NAME = '.token_broker.sock'
+AUTHKEY_NAME = '.token_broker.key'
+
+
+def get_authkey(token_dir: str, create: bool = False) -> Optional[bytes]:
+    path = f'{token_dir}/{AUTHKEY_NAME}'
+    if create:
+        authkey = os.urandom(32)
+        fd = os.open(f'{path}.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(authkey)
+        os.replace(f'{path}.tmp', path)
+        return authkey
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class TokenServer():
+    """
+    Serves the access token to the local processes over the unix socket
+    token_dir/.token_broker.sock, the clients are authenticated by the key in
+    token_dir/.token_broker.key readable by the service user only.
+    get_token(stale_token) returns the current token, stale_token is the token which
+    has been rejected by MDR, the token is refreshed if it's still the current one.
+    """
+
+    def __init__(self, token_dir: str, get_token: Callable[[Optional[str]], str]) -> None:
+        self.token_dir = token_dir
+        self.get_token = get_token
+        self.logger = logging.getLogger(__name__)
+
+
+    def start(self) -> None:
+        address = f'{self.token_dir}/{SOCKET_NAME}'
+        if os.path.exists(address):
+            os.remove(address)
+        self.listener = multiprocessing.connection.Listener(address = address, family = 'AF_UNIX', authkey = get_authkey(self.token_dir, create = True))
+        os.chmod(address, 0o600)
+        threading.Thread(target = self.serve, daemon = True).start()
+
+
+    def serve(self) -> None:
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+                self.logger.warning(f'token client rejected: {e}')
+                continue
+            threading.Thread(target = self.handle, args = (conn,), daemon = True).start()
+
+
+    def handle(self, conn: multiprocessing.connection.Connection) -> None:
+        try:
+            with conn:
+                command, stale_token = conn.recv()
+                if command == 'get':
+                    conn.send(self.get_token(stale_token))
+        except Exception as e:
+            self.logger.exception('token request has failed')
+
+
+class TokenClient():
+    """
+    Gets the access token from the token broker of TokenUpdater. If the broker
+    isn't available, e.g. the responder runs on another host, the token is read
+    from token_dir/.access_token.
+    Example:
+    client = TokenClient(token_dir)
+    mdr = MDRConsole(api_url = api_url, client_id = client_id, access_token = client.get(), token_provider = client.get)
+    """
+
+    def __init__(self, token_dir: str, timeout: float = 30) -> None:
+        self.token_dir = token_dir
+        self.timeout = timeout
+
+
+    def get(self, stale_token: Optional[str] = None) -> str:
+        """
+        stale_token - the token rejected by MDR with 401, a new one is requested
+        """
+        authkey = get_authkey(self.token_dir)
+        if authkey:
+            try:
+                with multiprocessing.connection.Client(f'{self.token_dir}/{SOCKET_NAME}', family = 'AF_UNIX', authkey = authkey) as conn:
+                    conn.send(('get', stale_token))
+                    if conn.poll(self.timeout):
+                        return conn.recv()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                pass
+        with open(f'{self.token_dir}/.access_token', 'r') as f:
+            return f.read()
@@ -1,11 +1,16 @@
+import os
 import yaml
 import time
+import random
 import logging
+import threading
 import jwt
 import datetime
 from typing import Optional, Dict, Any, List
 
 from src.mdr_api import MDRConsole
+from src.token_broker import TokenServer
+from src import metrics
 
 class TokenUpdater():
 
@@ -14,13 +19,25 @@ class TokenUpdater():
         client_id = config.get('client_id')
         ssl_cert = config.get('ssl_cert')
         self.period = config['token_updater'].get('period', 600)
+        self.refresh_ahead = config['token_updater'].get('refresh_ahead', 120)
+        self.jitter = config['token_updater'].get('jitter', 30)
         self.token_dir = config.get('token_dir', 'conf')
-        self.mdr = MDRConsole(api_url = api_url, client_id = client_id, ssl_cert = ssl_cert)
+        self.mdr = MDRConsole(api_url = api_url, client_id = client_id, ssl_cert = ssl_cert, http = config.get('http'))
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.refresh_at = 0
 
     def run(self, logging_queue, logging_configurer) -> None:
         logging_configurer(logging_queue)
         self.logger = logging.getLogger(__name__)
         self.logger.info('started')
+        with self.lock:
+            self.access_token = self.read_access_token()
+            self.schedule_refresh()
+        # the other processes get the token from the broker, .access_token is kept for the responder
+        TokenServer(self.token_dir, self.get_token).start()
+        metrics.register_gauge('mdr_token_expiry_seconds', self.get_expiry)
+        metrics.set_ready()
         while True:
             
             # check if refresh token is actual or it's needed to be updated
@@ -35,27 +52,55 @@ class TokenUpdater():
             else:
                 self.logger.error(f'You should fill {self.token_dir}/.refresh_token. Please take it from MDR Console (https://support.kaspersky.com/MDR/en-US/204468.htm).')
 
-            # check if access token is actual or it's needed to be updated
-            access_token = self.read_access_token()
-            need_update_access_token = False
-            if access_token:
-                access_token_exp = jwt.decode(access_token, options={"verify_signature": False}).get("exp")
-                self.logger.info(f'access_token expiration time: {datetime.datetime.fromtimestamp(access_token_exp)}')
-                if access_token_exp > time.time():
-                    self.logger.info(f'access_token is actual')
-                else:
-                    need_update_access_token = True
-            else:
-                need_update_access_token = True
-
-            if need_update_access_token:
-                refresh_token = self.read_refresh_token()
-                access_token, refresh_token = self.update_token(refresh_token)
-                self.write_access_token(access_token)
-                self.write_refresh_token(refresh_token)
+            # the access token is refreshed ahead of its expiration
+            with self.lock:
+                if time.time() >= self.refresh_at:
+                    self.refresh()
 
             self.logger.info('tokens updating finished')
-            time.sleep(self.period)
+            # a failed refresh is repeated in a minute at most
+            delay = min(self.period, max(self.refresh_at - time.time(), 1))
+            metrics.heartbeat(delay)
+            time.sleep(delay)
+
+    def get_exp(self, token: str) -> Optional[int]:
+        try:
+            return jwt.decode(token, options={"verify_signature": False}).get("exp")
+        except jwt.PyJWTError:
+            return None
+
+    def get_expiry(self) -> Optional[float]:
+        exp = self.get_exp(self.access_token) if self.access_token else None
+        return exp - time.time() if exp else None
+
+    def schedule_refresh(self) -> None:
+        exp = self.get_exp(self.access_token) if self.access_token else None
+        if exp is None:
+            self.refresh_at = 0
+            return
+        # jitter spreads the refreshes of several installations sharing a client
+        self.refresh_at = exp - self.refresh_ahead - random.uniform(0, self.jitter)
+        self.logger.info(f'access_token expiration time: {datetime.datetime.fromtimestamp(exp)}, it will be refreshed at {datetime.datetime.fromtimestamp(self.refresh_at)}')
+
+    def refresh(self) -> None:
+        # called under self.lock, refresh tokens are single-use
+        refresh_token = self.read_refresh_token()
+        access_token, refresh_token = self.update_token(refresh_token)
+        if not access_token:
+            self.refresh_at = time.time() + 60
+            return
+        self.write_access_token(access_token)
+        self.write_refresh_token(refresh_token)
+        self.access_token = access_token
+        self.schedule_refresh()
+
+    def get_token(self, stale_token: Optional[str] = None) -> str:
+        # served to the other processes by the token broker
+        with self.lock:
+            if not self.access_token or (stale_token and stale_token == self.access_token) or time.time() >= self.refresh_at:
+                self.logger.info('access_token is requested to be refreshed')
+                self.refresh()
+            return self.access_token
 
     def read_refresh_token(self):
         with open(f'{self.token_dir}/.refresh_token', 'r') as f:
@@ -68,12 +113,17 @@ class TokenUpdater():
         return access_token
     
     def write_refresh_token(self, refresh_token):
-        with open(f'{self.token_dir}/.refresh_token', 'w') as f:
-            f.write(refresh_token)
+        self.write_token_file('.refresh_token', refresh_token)
     
     def write_access_token(self, access_token):
-        with open(f'{self.token_dir}/.access_token', 'w') as f:
-            f.write(access_token)
+        self.write_token_file('.access_token', access_token)
+
+    def write_token_file(self, name, token):
+        # readers never see a half-written token
+        path = f'{self.token_dir}/{name}'
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(token)
+        os.replace(f'{path}.tmp', path)
 
     def update_token(self, refresh_token) -> None:
         refresh_token = self.read_refresh_token()